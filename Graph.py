@@ -1,7 +1,15 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from collections.abc import MutableMapping, MutableSet
 import itertools
+import operator
 from copy import deepcopy, copy
-from Primes import PRIMES
+from array import array
+import sys
+import Instrumentation
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class VertexMapping:
@@ -17,6 +25,14 @@ class VertexMapping:
             self.AtoB[v1] = v2
             self.BtoA[v2] = v1
     
+    @staticmethod
+    def snapshot(mapping):
+        # VertexMapping(mapping) without a call per item, the dict is copied
+        vm = VertexMapping.__new__(VertexMapping)
+        vm.AtoB = dict(mapping)
+        vm.BtoA = {b: a for a, b in mapping.items()}
+        return vm
+
     def remove_mapping(self, keys):
         for k in keys:
             if k in self:
@@ -65,52 +81,61 @@ class VertexMapping:
         return iter(self.AtoB.keys())
 
     def clone(self):
-        return deepcopy(self)
+        return Instrumentation.deepcopy(self)
         
 
 
-class Vertex:
+class Vertex(int):
+    # Vertices are plain ints under the hood, so hashing and comparing them
+    # in the graph's sets never runs Python code.
+    __slots__ = ()
     ID = 0
     def __new__(cls, n = 1):
         if n == 1:
-            return super(Vertex, cls).__new__(cls)
-        vs = []
-        for i in range(n):
-            v = super(Vertex, cls).__new__(cls)
-            v.__init__()
-            vs.append(v)
-        return vs
-
-    def __lt__(self, other):
-        return self.Id < other.Id
-    def __gt__(self, other):
-        return self.Id > other.Id
+            return cls.next()
+        return [cls.next() for i in range(n)]
 
-    def __init__(self):
-        self.Id = Vertex.ID
+    @classmethod
+    def next(cls):
+        v = cls.with_id(Vertex.ID)
         Vertex.ID += 1
+        return v
+
+    @classmethod
+    def with_id(cls, i):
+        return int.__new__(cls, i)
+
+    @property
+    def Id(self):
+        return int(self)
+
     def __str__(self):
         return str(self.Id)
     def __repr__(self):
         return str(self)
-    def __hash__(self):
-        return hash(self.Id)
-    def __eq__(self, other):
-        return self.Id == other.Id
+    def __reduce__(self):
+        return (Vertex.with_id, (self.Id,))
+    def __copy__(self):
+        return self
+    def __deepcopy__(self, memo):
+        return self
 
 class Edge:
-    PRIME_MAPPING = {}
+    __slots__ = ('Label', 'LabelId', 'Vertices', 'Neg', 'Hash')
+    # Every distinct label (negated labels included) is interned to a small
+    # int, used as its index in Graph.Counts
+    LABEL_IDS = {}
     def __init__(self, label, vertices, neg = False):
         if neg:
             label = "~" + label
-        if label not in Edge.PRIME_MAPPING.keys():
-            Edge.PRIME_MAPPING[label] = PRIMES[len(Edge.PRIME_MAPPING)]
-        self.Prime = Edge.PRIME_MAPPING[label]
+        if label not in Edge.LABEL_IDS.keys():
+            Edge.LABEL_IDS[label] = len(Edge.LABEL_IDS)
+        self.LabelId = Edge.LABEL_IDS[label]
         self.Label = label
 
-        self.Vertices = vertices
+        self.Vertices = tuple(vertices)
         self.Neg = neg
-        #self.HashCache = hash(self.Label) + sum(map(hash, self.Vertices))
+        self.Hash = hash((self.LabelId, self.Vertices))
 
     def map_vertices(self, mapping):
         vertices = []
@@ -136,14 +161,23 @@ class Edge:
     def __repr__(self):
         return str(self)
     def __hash__(self):
-        return hash(self.Label) + sum(map(hash, self.Vertices))
+        return self.Hash
     def __eq__(self, other):
-        return self.Label == other.Label and all(v1 == v2 for v1,v2 in zip(self, other))
+        return self.Hash == other.Hash and self.LabelId == other.LabelId and self.Vertices == other.Vertices
     def __iter__(self):
         return iter(self.Vertices)
     def __invert__(self):
         e = Edge(self.Label.lstrip('~'), self.Vertices, not self.Neg)
         return e
+    def __copy__(self):
+        return self
+    def __deepcopy__(self, memo):
+        # Edges are never modified once created
+        return self
+    def __getstate__(self):
+        return (self.Label.lstrip('~'), self.Vertices, self.Neg)
+    def __setstate__(self, state):
+        self.__init__(*state)
 
     def __lt__(self, other):
         if self.Label < other.Label:
@@ -154,140 +188,714 @@ class Edge:
             return True
         return tuple(self.Vertices) > tuple(other.Vertices)
 
+class DeltaSet(MutableSet):
+    # A set stored as the additions and removals on top of a base set that
+    # is shared with other graphs and never modified through this one.
+    MAX_DEPTH = 8
+
+    def __init__(self, base):
+        if isinstance(base, DeltaSet) and base.Depth >= DeltaSet.MAX_DEPTH:
+            base = set(base)
+        self.Base = base
+        self.Depth = base.Depth + 1 if isinstance(base, DeltaSet) else 1
+        self.Added = set()
+        self.Removed = set()
+        self.Size = len(base)
+
+    def __contains__(self, x):
+        if x in self.Added:
+            return True
+        if x in self.Removed:
+            return False
+        return x in self.Base
+
+    def __iter__(self):
+        for x in self.Base:
+            if x not in self.Removed:
+                yield x
+        yield from self.Added
+
+    def __len__(self):
+        return self.Size
+
+    def add(self, x):
+        if x in self:
+            return
+        if x in self.Removed:
+            self.Removed.remove(x)
+        else:
+            self.Added.add(x)
+        self.Size += 1
+
+    def discard(self, x):
+        if x not in self:
+            return
+        if x in self.Added:
+            self.Added.remove(x)
+        else:
+            self.Removed.add(x)
+        self.Size -= 1
+
+    def __repr__(self):
+        return repr(set(self))
+
+
+class DeltaMap(MutableMapping):
+    # The vertex -> incident edges map of a derived graph. Unchanged
+    # vertices share their edge sets with the base map, a vertex gets its
+    # own copy the first time its edges are modified.
+    def __init__(self, base):
+        if isinstance(base, DeltaMap) and base.Depth >= DeltaSet.MAX_DEPTH:
+            base = base.flatten()
+        self.Base = base
+        self.Depth = base.Depth + 1 if isinstance(base, DeltaMap) else 1
+        self.Local = {}
+        self.Removed = set()
+
+    def lookup(self, v):
+        if v in self.Local:
+            return self.Local[v]
+        if v in self.Removed:
+            return None
+        if isinstance(self.Base, DeltaMap):
+            return self.Base.lookup(v)
+        return self.Base.get(v)
+
+    def writable(self, v):
+        if v not in self.Local:
+            edges = self.lookup(v)
+            self.Local[v] = set() if edges is None else set(edges)
+        return self.Local[v]
+
+    def __getitem__(self, v):
+        edges = self.lookup(v)
+        if edges is None:
+            # Behave like the defaultdict(set) of a plain graph
+            edges = self.Local[v] = set()
+        return edges
+
+    def __setitem__(self, v, edges):
+        self.Local[v] = edges
+
+    def __delitem__(self, v):
+        if self.lookup(v) is None:
+            raise KeyError(v)
+        self.Local.pop(v, None)
+        self.Removed.add(v)
+
+    def __iter__(self):
+        for v in self.Base:
+            if v not in self.Local and v not in self.Removed:
+                yield v
+        yield from self.Local
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def flatten(self):
+        edge_map = defaultdict(set)
+        for v in self:
+            edge_map[v] = self[v]
+        return edge_map
+
+
 class Graph:
+    # A MatchCache that match, partial_match and containment go through
+    # when set
+    Cache = None
+    # Hosts with at least this many vertices have the domain of every
+    # pattern vertex narrowed down by Domains before a match searches
+    # them, None (the default) never does. Building the tables costs about
+    # as much as a full match, so it only pays off for matches that are
+    # enumerated to the end or fail, not for any(g.match(...)).
+    RefineFrom = None
+
     def __init__(self, edges = []):
         self.V = set()
         self.E = set()
         self.EdgeMap = defaultdict(set)
-        self.Prime = 1
+        # Number of edges per label id
+        self.Counts = array('L')
+        self.CanonicalCache = None
+        self.SubGraphsCache = None
+        self.DomainsCache = None
+        # Union-find over V for the connected components, kept up to date
+        # as edges are added. None once a removal may have split one.
+        self.ComponentRoots = {}
+        # Set while V, E and EdgeMap are the base of a derived graph
+        self.Shared = False
 
         for e in edges:
             self.add_edge(e)
-        self.process()
 
     def process(self):
-        self.SubGraphs = defaultdict(int)
-        seen = set()
+        # Components are worked out lazily and dropped on every change,
+        # so this only forgets what was cached.
+        self.SubGraphsCache = None
+
+    @property
+    def SubGraphs(self):
+        if self.SubGraphsCache is None:
+            sub_graphs = defaultdict(int)
+            components = self.components()
+            if len(components) == 1:
+                sub_graphs[self] += 1
+            else:
+                for component in components:
+                    sub_graphs[self[component]] += 1
+            self.SubGraphsCache = sub_graphs
+        return self.SubGraphsCache
+
+    def components(self):
+        if self.ComponentRoots is None:
+            self.ComponentRoots = {v: v for v in self.V}
+            for e in self.E:
+                self.__union(e)
+        components = defaultdict(set)
         for v in self.V:
-            if v not in seen:
-                component = self.connected_component(v)
-                seen |= component
-                if len(component) == len(self.V):
-                    self.SubGraphs[self] += 1
-                    break
-                self.SubGraphs[self[component]] += 1
+            components[self.__find(v)].add(v)
+        return list(components.values())
+
+    def __find(self, v):
+        roots = self.ComponentRoots
+        while roots[v] != v:
+            roots[v] = roots[roots[v]]
+            v = roots[v]
+        return v
+
+    def __union(self, e):
+        roots = self.ComponentRoots
+        for v in e:
+            roots.setdefault(v, v)
+        if e.Vertices:
+            root = self.__find(e.Vertices[0])
+            for v in e.Vertices[1:]:
+                other = self.__find(v)
+                if other != root:
+                    roots[other] = root
 
-    
     def connected_component(self, v, component = None):
         if component is None:
             component = set()
         component.add(v)
-        for e in self.EdgeMap[v]:
-            for v in e:
-                if v not in component:
-                    self.connected_component(v, component)
+        stack = [v]
+        while stack:
+            for e in self.EdgeMap[stack.pop()]:
+                for u in e:
+                    if u not in component:
+                        component.add(u)
+                        stack.append(u)
         return component
 
+    def derive(self):
+        # A copy of this graph that shares V, E and EdgeMap with it and only
+        # records its own changes. Both graphs stop writing to the shared
+        # structures, so deriving costs O(1) and later changes O(delta).
+        self.Shared = True
+        g = Graph.__new__(Graph)
+        g.V = DeltaSet(self.V)
+        g.E = DeltaSet(self.E)
+        g.EdgeMap = DeltaMap(self.EdgeMap)
+        g.Counts = array('L', self.Counts)
+        g.CanonicalCache = self.CanonicalCache
+        g.SubGraphsCache = None
+        g.DomainsCache = None
+        g.ComponentRoots = None
+        g.Shared = False
+        return g
+
+    def touched(self):
+        # The vertices whose edges differ from the graph this one was last
+        # derived from, or None if it was not derived
+        if not isinstance(self.E, DeltaSet):
+            return None
+        touched = set()
+        for e in itertools.chain(self.E.Added, self.E.Removed):
+            touched.update(e.Vertices)
+        if isinstance(self.V, DeltaSet):
+            touched |= self.V.Added | self.V.Removed
+        return touched
+
+    def added(self):
+        # The edges added since this graph was derived, or all of them if
+        # it was not derived
+        if isinstance(self.E, DeltaSet):
+            return set(self.E.Added)
+        return set(self.E)
+
+    def flatten(self):
+        # Copy the shared structures so this graph owns plain sets again
+        edge_map = defaultdict(set)
+        for v, edges in self.EdgeMap.items():
+            edge_map[v] = set(edges)
+        self.EdgeMap = edge_map
+        self.V = set(self.V)
+        self.E = set(self.E)
+        self.Shared = False
+
+    def __write(self):
+        if self.Shared:
+            self.V = DeltaSet(self.V)
+            self.E = DeltaSet(self.E)
+            self.EdgeMap = DeltaMap(self.EdgeMap)
+            self.Shared = False
+        self.CanonicalCache = None
+        self.SubGraphsCache = None
+        self.DomainsCache = None
+
+    def __incident(self, v):
+        # Edges of v that may be modified in place
+        if isinstance(self.EdgeMap, DeltaMap):
+            return self.EdgeMap.writable(v)
+        return self.EdgeMap[v]
+
+    def add_vertex(self, v):
+        if v not in self.V:
+            self.__write()
+            self.V.add(v)
+            self.__incident(v)
+            if self.ComponentRoots is not None:
+                self.ComponentRoots[v] = v
+
     def remove_vertex(self, v):
         if v in self.V:
+            self.__write()
+            for e in list(self.EdgeMap[v]):
+                self.remove_edge(e)
             self.V.remove(v)
-            for e in self.EdgeMap[v]:
-                self.E.remove(e)
-            del self.EdgeMap[v]
+            self.EdgeMap.pop(v, None)
 
     def remove_edge(self, e):
         if e in self.E:
+            self.__write()
+            self.ComponentRoots = None
             self.E.remove(e)
-            self.Prime /= e.Prime
+            self.Counts[e.LabelId] -= 1
             for v in set(e):
-                self.EdgeMap[v].remove(e)
+                self.__incident(v).remove(e)
 
     def add_edge(self, e):
         self.remove_edge(~e)
         if e not in self.E:
+            self.__write()
             self.E.add(e)
-            self.Prime *= e.Prime
+            if e.LabelId >= len(self.Counts):
+                self.Counts.extend(itertools.repeat(0, e.LabelId + 1 - len(self.Counts)))
+            self.Counts[e.LabelId] += 1
             for v in e:
                 self.V.add(v)
-                if e not in self.EdgeMap[v]:
-                    self.EdgeMap[v].add(e)
+                self.__incident(v).add(e)
+            if self.ComponentRoots is not None:
+                self.__union(e)
     
+    def could_contain(self, other):
+        # Cheap necessary condition for other in self: every label
+        # occurs in self at least as often as in other.
+        if len(other.Counts) > len(self.Counts) and any(other.Counts[len(self.Counts):]):
+            return False
+        return all(map(operator.ge, self.Counts, other.Counts))
+
+    def could_match(self, other, proper = False):
+        # Cheap necessary condition for a match of other in self: every
+        # label of the edges a match needs present occurs in self at least
+        # as often as in other. Proper matches only need the non-negated ones,
+        # other matches are not injective and can put several edges of
+        # other on one edge of self, so one of each label is enough.
+        needed = defaultdict(int)
+        for e in other.E:
+            if not proper:
+                needed[e.LabelId] = 1
+            elif not e.Neg:
+                needed[e.LabelId] += 1
+        return all(i < len(self.Counts) and self.Counts[i] >= c for i, c in needed.items())
+
+    def same_counts(self, other):
+        shared = min(len(self.Counts), len(other.Counts))
+        if any(self.Counts[shared:]) or any(other.Counts[shared:]):
+            return False
+        return self.Counts[:shared] == other.Counts[:shared]
+
+    def label_count(self, label):
+        i = Edge.LABEL_IDS.get(label)
+        if i is None or i >= len(self.Counts):
+            return 0
+        return self.Counts[i]
+
     def __contains__(self, other):
-        v = self.Prime / other.Prime
-        if int(v) != v:
+        if not self.could_contain(other):
             return False
-        return any(self.match(other))
+        if Graph.Cache is not None:
+            return Graph.Cache.contains(self, other)
+        return any(self.match_uncached(other))
 
-    def match(self, other, proper = False):
+    def match(self, other, proper = False, before = None):
+        if Graph.Cache is not None:
+            bounds = Graph.order_bounds(before)
+            return (m for m in Graph.Cache.match(self, other, proper)
+                if all(Graph.ordered(v, m, bounds) for v in bounds))
+        return self.match_uncached(other, proper, before)
+
+    def match_uncached(self, other, proper = False, before = None):
         # Checking containment amounts to finding a vertex mapping M from 
         # other.V -> self.V for all other.V such that if R(other.V) then R(M(self.V))
-        # v = self.Prime / other.Prime
-        # if int(v) != v and not proper:
-        #     return
-        if len(other.V) > len(self.V):
+        # Proper matches are injective and treat a missing edge as negated,
+        # otherwise every edge of other (negated or not) must be in self.
+        # before is a list of pairs (u, v) of vertices of other, only
+        # matches mapping u below v for every pair are yielded.
+        if Instrumentation.Enabled:
+            Instrumentation.Counters['match.calls'] += 1
+        if len(other.V) > len(self.V) or not self.could_match(other, proper):
             return
-        vertices = list(other.V)
+        keys = set()
+        label_counts = defaultdict(int)
+        for e in self.E:
+            keys.add((e.Label, tuple(e.Vertices)))
+            label_counts[e.Label] += 1
 
-        if not proper:
-            for mapping in self.__match(other, vertices, proper = proper):
-                g = mapping(other)
-                for e in g.E:
-                    if e not in self.E:
-                        break
-                    if ~e in self.E:
-                        break
-                else:
-                    yield mapping
-            return
+        domains = None
+        if Graph.RefineFrom is not None and len(self.V) >= Graph.RefineFrom and len(other.V) > 1:
+            if self.DomainsCache is None:
+                self.DomainsCache = Domains(self)
+            domains = self.DomainsCache.refine(other, proper)
+            if domains is None:
+                return
+        order = self.__match_order(other, label_counts, proper)
+        yield from self.__match(other, order, keys, proper, Graph.order_bounds(before), domains)
+
+    @staticmethod
+    def order_bounds(before):
+        # For every vertex in before, the other vertex of each of its pairs
+        # and whether its image has to be the smaller one. Shared with
+        # IncrementalMatcher, as is ordered.
+        bounds = defaultdict(list)
+        for u, v in before or ():
+            bounds[u].append((v, True))
+            bounds[v].append((u, False))
+        return bounds
 
-        # Try all mappings
-        for perm in itertools.permutations(self.V, len(other.V)):
-            mapping = VertexMapping({v1: v2 for v1, v2 in zip(vertices, perm)})
-            g = mapping(other)
-            for e in g.E:
+    @staticmethod
+    def ordered(v, mapping, bounds):
+        for u, below in bounds.get(v, ()):
+            if u in mapping and (mapping[v] < mapping[u]) != below:
+                return False
+        return True
+
+    @staticmethod
+    def __binds(e, proper):
+        # Whether the pattern edge e has to be present in the matched graph
+        return not (proper and e.Neg)
+
+    def __match_order(self, other, label_counts, proper):
+        # Order the pattern vertices so that every vertex after the first of its
+        # component is connected to one already placed, preferring vertices
+        # with many placed neighbours and rare labels.
+        rarity = {}
+        for v in other.V:
+            counts = [label_counts[e.Label] for e in other.EdgeMap[v] if Graph.__binds(e, proper)]
+            rarity[v] = min(counts) if counts else len(self.V)
+
+        order = []
+        placed = set()
+        links = defaultdict(int)
+        remaining = set(other.V)
+        while remaining:
+            v = min(remaining, key = lambda v: (-links[v], rarity[v], -len(other.EdgeMap[v]), v))
+            remaining.remove(v)
+            placed.add(v)
+            order.append(v)
+            for e in other.EdgeMap[v]:
+                if Graph.__binds(e, proper):
+                    for u in e:
+                        if u not in placed:
+                            links[u] += 1
+        return order
+
+    def __label_degrees(self, v, cache):
+        if v not in cache:
+            degrees = defaultdict(int)
+            for e in self.EdgeMap[v]:
+                degrees[e.Label] += 1
+            cache[v] = degrees
+        return cache[v]
+
+    def __match_plan(self, other, order, proper, domains):
+        # What __match needs at each depth, worked out once per call: the
+        # vertex placed, the edges of each label it needs in the host, the
+        # edges it closes (all vertices placed) as the labels their image
+        # must and must not have, the edge its candidates are reached
+        # through from a placed neighbour, if any, and its domain if the
+        # domains were refined.
+        placed = set()
+        plan = []
+        for v in order:
+            required = defaultdict(int)
+            closes = []
+            through = None
+            for e in other.EdgeMap[v]:
+                binds = Graph.__binds(e, proper)
+                if binds:
+                    required[e.Label] += 1
+                if all(u == v or u in placed for u in e):
+                    label = e.Label.lstrip('~')
+                    if not e.Neg:
+                        closes.append((e.Vertices, label, '~' + label))
+                    elif proper:
+                        closes.append((e.Vertices, None, label))
+                    else:
+                        closes.append((e.Vertices, e.Label, label))
+                if binds and through is None:
+                    for j, u in enumerate(e.Vertices):
+                        if u in placed:
+                            through = (e.Label, len(e.Vertices), e.Vertices.index(v), j, u)
+                            break
+            placed.add(v)
+            minimum = tuple((l, c if proper else 1) for l, c in required.items())
+            plan.append((v, minimum, tuple(closes), through, None if domains is None else domains[v]))
+        return plan
+
+    def __candidates(self, through, domain, mapping, reached):
+        # Host vertices reachable from the image of a placed neighbour
+        # through an edge with the same label and position, or every vertex
+        # (of the domain if there is one) otherwise. Kept in reached for the
+        # rest of the call.
+        if through is None:
+            if domain is not None:
+                return [h for h in self.V if h in domain]
+            return self.V
+        label, arity, i, j, u = through
+        hu = mapping[u]
+        key = (label, arity, i, j, hu)
+        if key not in reached:
+            reached[key] = set(
+                e2.Vertices[i] for e2 in self.EdgeMap[hu]
+                if e2.Label == label and len(e2.Vertices) == arity and e2.Vertices[j] == hu
+            )
+        return reached[key]
+
+    @staticmethod
+    def __holds(e, mapping, keys, proper):
+        # Whether the image of the pattern edge e, all of whose vertices
+        # are mapped, is consistent with the host
+        vertices = tuple(mapping[u] for u in e)
+        label = e.Label.lstrip('~')
+        if e.Neg:
+            if (label, vertices) in keys:
+                return False
+            if not proper and (e.Label, vertices) not in keys:
+                return False
+        else:
+            if (label, vertices) not in keys or ('~' + label, vertices) in keys:
+                return False
+        return True
+
+    def __consistent(self, other, v, mapping, keys, proper):
+        # Check every edge of v whose vertices have all been mapped
+        for e in other.EdgeMap[v]:
+            if all(u in mapping for u in e) and not Graph.__holds(e, mapping, keys, proper):
+                return False
+        return True
+
+    def __match(self, other, order, keys, proper, bounds, domains = None):
+        # Depth first over the vertices in order, without recursion: stack
+        # holds the candidates left at each depth and a single mapping is
+        # changed in place, the choice at a depth being undone before the
+        # next one is tried. Only complete matches are copied out.
+        plan = self.__match_plan(other, order, proper, domains)
+        n = len(plan)
+        if n == 0:
+            yield VertexMapping()
+            return
+        counting = Instrumentation.Enabled
+        mapping = {}
+        used = set()
+        degree_cache = {}
+        reached = {}
+        stack = [iter(self.__candidates(plan[0][3], plan[0][4], mapping, reached))]
+        while stack:
+            depth = len(stack) - 1
+            v, required, closes, _, domain = plan[depth]
+            if v in mapping:
                 if proper:
-                    if not e.Neg and not e in self.E:
-                        break
-                    if ~e in self.E:
+                    used.remove(mapping[v])
+                del mapping[v]
+            for v2 in stack[depth]:
+                if proper and v2 in used:
+                    continue
+                if domain is not None and v2 not in domain:
+                    continue
+                # Injective matches need as many edges of each label, others
+                # only need the label to be present.
+                degrees = self.__label_degrees(v2, degree_cache)
+                for l, c in required:
+                    if degrees[l] < c:
                         break
                 else:
-                    if e not in self.E:
-                        break
-                    if ~e in self.E:
-                        break
+                    mapping[v] = v2
+                    if counting:
+                        Instrumentation.Counters['match.tried'] += 1
+                    for vertices, needs, forbids in closes:
+                        image = tuple([mapping[u] for u in vertices])
+                        if (needs is not None and (needs, image) not in keys) or (forbids, image) in keys:
+                            break
+                    else:
+                        if Graph.ordered(v, mapping, bounds):
+                            break
+                    del mapping[v]
+            else:
+                stack.pop()
+                continue
+            if proper:
+                used.add(v2)
+            if depth + 1 == n:
+                if counting:
+                    Instrumentation.Counters['match.yielded'] += 1
+                yield VertexMapping.snapshot(mapping)
             else:
-                yield mapping
-        return
+                stack.append(iter(self.__candidates(plan[depth + 1][3], plan[depth + 1][4], mapping, reached)))
+
+    def partial_match(self, other):
+        if Graph.Cache is not None:
+            return iter(Graph.Cache.partial_match(self, other))
+        return self.partial_match_uncached(other)
 
-    def __match(self, other, remaining_verts : list, mapping = None, proper = False):
-        if mapping is None:
-            mapping = VertexMapping()
+    def partial_match_uncached(self, other):
+        # Every partial (non-injective) mapping of other.V into self.V such
+        # that each mapped vertex has an edge among the mapped vertices, and
+        # all those edges are in self as in a non-proper match. Unmapped
+        # vertices are left for the caller to create.
+        if Instrumentation.Enabled:
+            Instrumentation.Counters['match.calls'] += 1
+        keys = set()
+        label_counts = defaultdict(int)
+        for e in self.E:
+            keys.add((e.Label, tuple(e.Vertices)))
+            label_counts[e.Label] += 1
 
-        if len(remaining_verts) == 0:
-            yield mapping
+        order = self.__match_order(other, label_counts, False)
+        position = {v: i for i, v in enumerate(order)}
+        # settled[i] are the vertices whose neighbours are all decided once
+        # order[i] is, from then on they must have a mapped edge or no image
+        settled = defaultdict(list)
+        for v in order:
+            last = position[v]
+            for e in other.EdgeMap[v]:
+                for u in e:
+                    last = max(last, position[u])
+            settled[last].append(v)
+        yield from self.__partial_match(other, order, settled, keys, {})
+
+    def __partial_match(self, other, order, settled, keys, mapping, depth = 0):
+        if depth == len(order):
+            # As for match, no more vertices than self has can be mapped
+            if len(mapping) <= len(self.V):
+                if Instrumentation.Enabled:
+                    Instrumentation.Counters['match.yielded'] += 1
+                yield VertexMapping(mapping)
             return
-        
-        v = remaining_verts[0]
-        remaining_verts = remaining_verts[1:]
-        if v in mapping:
-            for full_mapping in self.__match(other, remaining_verts, mapping, proper):
-                yield full_mapping
-
-        for v2 in self.V:
-            for e1 in other.EdgeMap[v]:
-                found = False
-                for e2 in self.EdgeMap[v2]:
-                    if e1.Label == e2.Label:
-                        found = True
-                        break
-                if not found:
-                    break
-            else:
-                m = mapping.clone()
-                
-                m.add_mapping({v:v2})
-                for full_mapping in self.__match(other, remaining_verts, m, proper):
-                    yield full_mapping
+
+        v = order[depth]
+        # Edges to mapped vertices only constrain v if they end up mapped,
+        # so the candidates come from an edge whose other vertices are all
+        # mapped already.
+        candidates = self.V
+        for e1 in other.EdgeMap[v]:
+            others = [j for j, u in enumerate(e1.Vertices) if u != v]
+            if others and all(e1.Vertices[j] in mapping for j in others):
+                i = e1.Vertices.index(v)
+                j = others[0]
+                hu = mapping[e1.Vertices[j]]
+                candidates = set(
+                    e2.Vertices[i] for e2 in self.EdgeMap[hu]
+                    if e2.Label == e1.Label and len(e2.Vertices) == len(e1.Vertices) and e2.Vertices[j] == hu
+                )
+                break
+
+        for v2 in itertools.chain(candidates, [None]):
+            if v2 is not None:
+                mapping[v] = v2
+                if Instrumentation.Enabled:
+                    Instrumentation.Counters['match.tried'] += 1
+                if not self.__consistent(other, v, mapping, keys, False):
+                    del mapping[v]
+                    continue
+            if all(
+                u not in mapping or any(all(w in mapping for w in e) for e in other.EdgeMap[u])
+                for u in settled[depth]
+            ):
+                yield from self.__partial_match(other, order, settled, keys, mapping, depth + 1)
+            if v2 is not None:
+                del mapping[v]
+
+    def symmetry_breaking(self, vertices = None):
+        # Pairs (u, v) such that of the matches of a pattern that only
+        # differ by an automorphism of self, one maps u below v for every
+        # pair. Only the automorphisms mapping vertices (by default V) onto
+        # themselves count. Each vertex in turn goes below every other vertex
+        # of its orbit under the automorphisms fixing the ones before it.
+        vertices = set(self.V if vertices is None else vertices)
+        keys = set((e.Label, e.Vertices) for e in self.E)
+        signatures = {}
+        for v in self.V:
+            signature = [(e.Label, i) for e in self.EdgeMap[v] for i, u in enumerate(e) if u == v]
+            signatures[v] = (v in vertices, tuple(sorted(signature)))
+
+        pairs = []
+        fixed = {}
+        for v in sorted(vertices):
+            for u in sorted(vertices):
+                if u == v or u in fixed or signatures[u] != signatures[v]:
+                    continue
+                seed = dict(fixed)
+                seed[v] = u
+                if self.__automorphism(seed, signatures, keys):
+                    pairs.append((v, u))
+            fixed[v] = v
+        return pairs
+
+    def __automorphism(self, seed, signatures, keys):
+        # Whether seed extends to an automorphism keeping signatures
+        mapping = dict(seed)
+        if not all(self.__preserves(v, mapping, keys) for v in seed):
+            return False
+        # Vertices next to mapped ones first, so that wrong choices fail early
+        rest = []
+        links = defaultdict(int)
+        remaining = set(self.V) - set(mapping)
+        for v in mapping:
+            for e in self.EdgeMap[v]:
+                for u in e:
+                    links[u] += 1
+        while remaining:
+            v = min(remaining, key = lambda v: (-links[v], v))
+            remaining.remove(v)
+            rest.append(v)
+            for e in self.EdgeMap[v]:
+                for u in e:
+                    links[u] += 1
+        return self.__extend(rest, mapping, set(mapping.values()), signatures, keys)
+
+    def __extend(self, rest, mapping, used, signatures, keys, depth = 0):
+        if depth == len(rest):
+            return True
+        v = rest[depth]
+        for h in self.V:
+            if h in used or signatures[h] != signatures[v]:
+                continue
+            mapping[v] = h
+            used.add(h)
+            if self.__preserves(v, mapping, keys) and self.__extend(rest, mapping, used, signatures, keys, depth + 1):
+                return True
+            used.remove(h)
+            del mapping[v]
+        return False
+
+    def __preserves(self, v, mapping, keys):
+        # Every edge of v with all vertices mapped is mapped onto an edge
+        for e in self.EdgeMap[v]:
+            if all(u in mapping for u in e):
+                if (e.Label, tuple(mapping[u] for u in e)) not in keys:
+                    return False
+        return True
 
     def apply(self, other, mapping):
         for e in mapping(other).E:
@@ -297,14 +905,18 @@ class Graph:
         for e in mapping(other).E:
             self.remove_edge(e)
 
-    def prune(self):
+    def prune(self, vertices = None):
+        # Drop the vertices without edges, only looking at vertices if given
         to_remove = []
-        for v in self.V:
+        for v in (self.V if vertices is None else [v for v in vertices if v in self.V]):
             if len(self.EdgeMap[v]) == 0:
                 to_remove.append(v)
         for v in to_remove:
+            self.__write()
             self.V.remove(v)
             del self.EdgeMap[v]
+            if self.ComponentRoots is not None:
+                self.ComponentRoots.pop(v, None)
 
     def clone(self):
         mapping = VertexMapping()
@@ -313,51 +925,224 @@ class Graph:
     def __deepcopy__(self, memo):
         return Graph([deepcopy(e, memo) for e in self.E])
 
+    def __getstate__(self):
+        # Pickled flat, without structure shared with other graphs. The
+        # canonical form is kept since it is the expensive part to rebuild.
+        return {'E': list(self.E), 'V': list(self.V), 'Canonical': self.CanonicalCache}
+
+    def __setstate__(self, state):
+        self.__init__(state['E'])
+        for v in state['V']:
+            self.add_vertex(v)
+        self.CanonicalCache = state.get('Canonical')
+
+    def canonical(self):
+        # A string that is identical for two graphs iff they are isomorphic
+        return self.__canonical_form()[0]
+
+    def canonical_order(self):
+        # The vertices in canonical order, so the i-th vertex of two
+        # isomorphic graphs are mapped onto each other
+        return self.__canonical_form()[1]
+
+    def __canonical_form(self):
+        if self.CanonicalCache is None:
+            if Instrumentation.Enabled:
+                Instrumentation.Counters['canonical.computed'] += 1
+            components = [self.__canonical_component(c) for c in self.components()]
+            components.sort(key = lambda c: c[0])
+            order = []
+            for _, component_order in components:
+                order.extend(component_order)
+            self.CanonicalCache = ('|'.join(c for c, _ in components), order)
+        return self.CanonicalCache
+
+    def __refine(self, colours, cells, open_cells, changed):
+        # Colour refinement on an ordered partition: the colour of a vertex
+        # is the position of its cell, and cells are split by the colours of
+        # the neighbours (per edge label and position) until nothing changes.
+        # Only cells next to vertices whose cell was split off are
+        # re-examined, so one individualization costs about the size of the
+        # neighbourhoods it affects.
+        while changed:
+            dirty = set()
+            for v in changed:
+                for e in self.EdgeMap[v]:
+                    for u in e:
+                        dirty.add(colours[u])
+            splits = []
+            for position in sorted(dirty):
+                cell = cells[position]
+                if len(cell) == 1:
+                    continue
+                signatures = {}
+                for v in cell:
+                    incident = []
+                    for e in self.EdgeMap[v]:
+                        neighbours = tuple(map(colours.__getitem__, e.Vertices))
+                        for i, u in enumerate(e.Vertices):
+                            if u == v:
+                                incident.append((e.Label, i, neighbours))
+                    incident.sort()
+                    signatures[v] = tuple(incident)
+                if len(set(signatures.values())) > 1:
+                    splits.append((position, signatures))
+
+            changed = []
+            for position, signatures in splits:
+                open_cells.discard(position)
+                parts = defaultdict(list)
+                for v, s in signatures.items():
+                    parts[s].append(v)
+                parts = [parts[s] for s in sorted(parts)]
+                largest = max(range(len(parts)), key = lambda i: len(parts[i]))
+                for i, part in enumerate(parts):
+                    cells[position] = part
+                    if len(part) > 1:
+                        open_cells.add(position)
+                    for v in part:
+                        colours[v] = position
+                    if i != largest:
+                        changed.extend(part)
+                    position += len(part)
+        return colours, cells, open_cells
+
+    def __twins(self, cell):
+        # Whether the vertices of cell have the same edges apart from
+        # themselves, so that any permutation of them is an automorphism
+        neighbourhoods = set()
+        for v in cell:
+            neighbourhoods.add(frozenset(
+                (e.Label, tuple(None if u == v else u for u in e)) for e in self.EdgeMap[v]
+            ))
+            if len(neighbourhoods) > 1:
+                return False
+        return True
+
+    def __canonical_component(self, vertices):
+        # Individualization-refinement over the colour classes of one
+        # connected component. The smallest certificate among the leaves is
+        # canonical; automorphisms found along the way prune symmetric
+        # branches.
+        search = {'first': None, 'best': None, 'autos': []}
+
+        def leaf(cells, path):
+            if Instrumentation.Enabled:
+                Instrumentation.Counters['canonical.leaves'] += 1
+            order = [cells[i][0] for i in range(len(vertices))]
+            colours = {v: i for i, v in enumerate(order)}
+            # Compared as a set first, most leaves are images of the first one
+            cert = frozenset((e.Label, tuple(map(colours.__getitem__, e.Vertices))) for e in edges)
+            if search['first'] is None:
+                search['first'] = (cert, order, path)
+                search['best'] = (tuple(sorted(cert)), order, cert)
+                return None
+            first_cert, first_order, first_path = search['first']
+            common = 0
+            while common < len(path) and path[common] == first_path[common]:
+                common += 1
+            if cert == first_cert:
+                add_automorphism(first_order, order, common)
+                # Everything below the last shared node of the first path is
+                # an image of what was already explored from there.
+                return common
+            if cert == search['best'][2]:
+                add_automorphism(search['best'][1], order, None)
+                return None
+            ordered = tuple(sorted(cert))
+            if ordered < search['best'][0]:
+                search['best'] = (ordered, order, cert)
+            return None
+
+        def add_automorphism(a, b, fixed):
+            # fixed is how much of the first path the automorphism is known
+            # to fix, if it was found against the first leaf
+            search['autos'].append(({u: w for u, w in zip(a, b) if u != w}, fixed))
+
+        def orbits(path, on_first_path):
+            # Orbits of the automorphisms found so far that fix the path
+            parent = {}
+            def find(u):
+                while parent.get(u, u) != u:
+                    u = parent[u]
+                return u
+            for auto, fixed in search['autos']:
+                if on_first_path and fixed is not None and fixed >= len(path):
+                    fixes = True
+                else:
+                    fixes = all(auto.get(u, u) == u for u in path)
+                if fixes:
+                    for a, b in auto.items():
+                        ra, rb = find(a), find(b)
+                        if ra != rb:
+                            parent[max(ra, rb)] = min(ra, rb)
+            return find
+
+        def explore(colours, cells, open_cells, changed, path):
+            depth = len(path)
+            path = list(path)
+            while True:
+                colours, cells, open_cells = self.__refine(colours, cells, open_cells, changed)
+                if not open_cells:
+                    return leaf(cells, path)
+                target = min(open_cells)
+                cell = sorted(cells[target])
+                if not self.__twins(cell):
+                    break
+                # Every order of the twins gives the same leaves, so they are
+                # individualized together without branching.
+                for i, v in enumerate(cell):
+                    cells[target + i] = [v]
+                    colours[v] = target + i
+                open_cells.discard(target)
+                changed = cell
+                path.extend(cell)
+
+            tried = set()
+            known = -1
+            for v in cell:
+                if tried and known != len(search['autos']):
+                    known = len(search['autos'])
+                    on_first_path = search['first'][2][:len(path)] == path
+                    find = orbits(path, on_first_path)
+                if tried and any(find(v) == find(u) for u in tried):
+                    continue
+                tried.add(v)
+                # v keeps the position of its cell, the rest move up by one
+                individualized = dict(colours)
+                individualized_cells = dict(cells)
+                individualized_cells[target] = [v]
+                individualized_cells[target + 1] = [u for u in cell if u != v]
+                for u in individualized_cells[target + 1]:
+                    individualized[u] = target + 1
+                individualized_open = open_cells - {target}
+                if len(cell) > 2:
+                    individualized_open.add(target + 1)
+                jump = explore(individualized, individualized_cells, individualized_open, [v], path + [v])
+                if jump is not None and jump < depth:
+                    return jump
+            return None
+
+        edges = set()
+        for v in vertices:
+            edges |= self.EdgeMap[v]
+        vertices = sorted(vertices)
+        explore({v: 0 for v in vertices}, {0: vertices}, {0} if len(vertices) > 1 else set(), vertices, [])
+        cert, order, _ = search['best']
+        inner = ';'.join(f'{label}({",".join(map(str, indices))})' for label, indices in cert)
+        return f'{len(vertices)}:{inner}', order
+
     def __hash__(self):
-        return hash(self.Prime)
+        return hash(self.canonical())
 
     def __eq__(self, other):
-        if self.Prime != other.Prime:
+        if not self.same_counts(other):
             return False
-        
-        if len(self.SubGraphs) != len(other.SubGraphs):
+        if len(self.V) != len(other.V) or len(self.E) != len(other.E):
             return False
-        if len(self.SubGraphs) > 1:
-            for a, c in self.SubGraphs.items():
-                if a not in other.SubGraphs.keys() or other.SubGraphs[a] != c:
-                    return False
-            return True
-        prime_a = defaultdict(list)
-        prime_b = defaultdict(list)
-        for v in other.V:
-            p = 1
-            for e in other.EdgeMap[v]:
-                p *= e.Prime
-            prime_a[p].append(v)
-        for v in self.V:
-            p = 1
-            for e in self.EdgeMap[v]:
-                p *= e.Prime
-            prime_b[p].append(v)
-
-        mapping_groups = []
-        for k in prime_a.keys():
-            a = prime_a[k]
-            b = prime_b[k]
-            mapping_groups.append(
-                [itertools.zip_longest(perm, b) for perm in itertools.permutations(a)]
-            )
-        for mapping in itertools.product(*mapping_groups):
-            vm = VertexMapping({k:v for k,v in itertools.chain(*mapping)})
-            for e in other.E:
-                e = e.map_vertices(vm)
-                if e not in self.E:
-                    break
-                if ~e in self.E:
-                    break
-            else:
-                return True
-        return False
+        if Instrumentation.Enabled:
+            Instrumentation.Counters['eq.canonical'] += 1
+        return self.canonical() == other.canonical()
 
     def __str__(self):
         return str(dict(self.EdgeMap))
@@ -379,6 +1164,470 @@ class Graph:
         return Graph(edges)
 
 
+class Domains:
+    # Ullmann style narrowing of the host vertices each pattern vertex can
+    # be mapped to, before any search. A host vertex stays in the domain of
+    # a pattern vertex while it has as many edges of each label as the
+    # pattern vertex needs and, for every binding edge to another pattern
+    # vertex, an edge with the same label and positions to some vertex in
+    # that one's domain. Repeated until nothing changes. Domains are boolean
+    # vectors over the host vertices with NumPy and int bitsets otherwise.
+    def __init__(self, g):
+        self.Vertices = list(g.V)
+        position = {v: i for i, v in enumerate(self.Vertices)}
+        n = len(self.Vertices)
+        # Edges of each label at every host vertex
+        degrees = defaultdict(lambda: [0] * n)
+        for v, i in position.items():
+            for e in g.EdgeMap[v]:
+                degrees[e.Label][i] += 1
+        # (label, arity, j, i) -> the (vertex at j, vertex at i) pairs of the
+        # edges with that label and arity
+        links = defaultdict(list)
+        for e in g.E:
+            k = len(e.Vertices)
+            for j in range(k):
+                for i in range(k):
+                    if i != j:
+                        links[(e.Label, k, j, i)].append((position[e.Vertices[j]], position[e.Vertices[i]]))
+
+        if numpy is not None:
+            self.Degrees = {l: numpy.array(d) for l, d in degrees.items()}
+            self.Links = {key: numpy.array(pairs).T for key, pairs in links.items()}
+        else:
+            self.Degrees = dict(degrees)
+            # Bitsets of the vertices at i for every vertex at j
+            self.Links = {}
+            for key, pairs in links.items():
+                rows = defaultdict(int)
+                for a, b in pairs:
+                    rows[a] |= 1 << b
+                self.Links[key] = rows
+
+    def refine(self, other, proper):
+        # {pattern vertex: set of host vertices}, or None if some pattern
+        # vertex has nowhere to go. Only edges a match needs present count,
+        # as in Graph.match.
+        n = len(self.Vertices)
+        required = {v: defaultdict(int) for v in other.V}
+        arcs = []
+        for e in other.E:
+            if proper and e.Neg:
+                continue
+            k = len(e.Vertices)
+            for u in set(e):
+                required[u][e.Label] += 1
+            for j, u in enumerate(e.Vertices):
+                for i, w in enumerate(e.Vertices):
+                    if i != j:
+                        arcs.append((u, (e.Label, k, j, i), w))
+
+        domains = {}
+        for v, labels in required.items():
+            domain = numpy.ones(n, dtype = bool) if numpy is not None else (1 << n) - 1
+            for l, c in labels.items():
+                degrees = self.Degrees.get(l)
+                if degrees is None:
+                    return None
+                c = c if proper else 1
+                if numpy is not None:
+                    domain &= degrees >= c
+                else:
+                    domain &= sum(1 << i for i, d in enumerate(degrees) if d >= c)
+            domains[v] = domain
+
+        changed = True
+        while changed:
+            changed = False
+            for u, key, w in arcs:
+                narrowed = self.__supported(domains[u], key, domains[w], u == w)
+                if numpy is not None:
+                    if not narrowed.any():
+                        return None
+                    if narrowed.sum() < domains[u].sum():
+                        domains[u] = narrowed
+                        changed = True
+                else:
+                    if not narrowed:
+                        return None
+                    if narrowed != domains[u]:
+                        domains[u] = narrowed
+                        changed = True
+        if Instrumentation.Enabled:
+            Instrumentation.Counters['match.refined'] += 1
+
+        if numpy is not None:
+            return {v: set(self.Vertices[i] for i in numpy.flatnonzero(d)) for v, d in domains.items()}
+        return {v: set(self.Vertices[i] for i in Domains.__members(d)) for v, d in domains.items()}
+
+    def __supported(self, domain, key, targets, loop):
+        # The vertices of domain with a key edge to one of targets, to
+        # themselves if loop
+        links = self.Links.get(key)
+        if numpy is not None:
+            if links is None:
+                return numpy.zeros_like(domain)
+            a, b = links
+            ok = a == b if loop else targets[b]
+            supported = numpy.zeros_like(domain)
+            supported[a[ok]] = True
+            return domain & supported
+        if links is None:
+            return 0
+        supported = 0
+        for h in Domains.__members(domain):
+            row = links.get(h, 0)
+            if (row >> h) & 1 if loop else row & targets:
+                supported |= 1 << h
+        return supported
+
+    @staticmethod
+    def __members(bits):
+        while bits:
+            low = bits & -bits
+            yield low.bit_length() - 1
+            bits ^= low
+
+
+class MatchCache:
+    # Results of match, partial_match and containment keyed by the
+    # canonical forms of both graphs, so that they are found again for any
+    # isomorphic pair. Mappings are stored between canonical positions and
+    # moved onto the caller's vertices through canonical_order. The least
+    # recently used entries go once there are more than max_entries or
+    # they take more than max_bytes.
+    #
+    #   Graph.Cache = MatchCache(max_bytes = 256 << 20)
+    def __init__(self, max_entries = 100000, max_bytes = None):
+        self.MaxEntries = max_entries
+        self.MaxBytes = max_bytes
+        self.Entries = OrderedDict()
+        self.Bytes = 0
+        self.Hits = 0
+        self.Misses = 0
+        self.Evictions = 0
+
+    def match(self, g, pattern, proper = False):
+        return self.__mappings(('match', proper), g, pattern, lambda: g.match_uncached(pattern, proper))
+
+    def partial_match(self, g, pattern):
+        return self.__mappings(('partial',), g, pattern, lambda: g.partial_match_uncached(pattern))
+
+    def contains(self, g, pattern):
+        key = ('contains', g.canonical(), pattern.canonical())
+        stored = self.__get(key)
+        if stored is None:
+            stored = any(g.match_uncached(pattern))
+            self.__put(key, stored, 0)
+        return stored
+
+    def __mappings(self, kind, g, pattern, compute):
+        key = (kind, g.canonical(), pattern.canonical())
+        g_order = g.canonical_order()
+        pattern_order = pattern.canonical_order()
+        stored = self.__get(key)
+        if stored is None:
+            g_index = {v: i for i, v in enumerate(g_order)}
+            pattern_index = {v: i for i, v in enumerate(pattern_order)}
+            stored = tuple(
+                tuple((pattern_index[a], g_index[b]) for a, b in m.AtoB.items())
+                for m in compute()
+            )
+            self.__put(key, stored, sum(sys.getsizeof(m) for m in stored))
+        return [VertexMapping({pattern_order[a]: g_order[b] for a, b in m}) for m in stored]
+
+    def __get(self, key):
+        entry = self.Entries.get(key)
+        if entry is None:
+            self.Misses += 1
+            return None
+        self.Hits += 1
+        self.Entries.move_to_end(key)
+        return entry[0]
+
+    def __put(self, key, value, size):
+        size += sys.getsizeof(key[1]) + sys.getsizeof(key[2]) + sys.getsizeof(value)
+        self.Entries[key] = (value, size)
+        self.Bytes += size
+        while self.Entries and (len(self.Entries) > self.MaxEntries or (self.MaxBytes is not None and self.Bytes > self.MaxBytes)):
+            _, (_, evicted) = self.Entries.popitem(last = False)
+            self.Bytes -= evicted
+            self.Evictions += 1
+
+    def clear(self):
+        self.Entries.clear()
+        self.Bytes = 0
+
+    def stats(self):
+        lookups = self.Hits + self.Misses
+        return {
+            'hits': self.Hits,
+            'misses': self.Misses,
+            'evictions': self.Evictions,
+            'entries': len(self.Entries),
+            'bytes': self.Bytes,
+            'hit_rate': self.Hits / lookups if lookups else 0.0,
+        }
+
+
+class PatternTrie:
+    # Many patterns matched properly against a graph in one pass. Every
+    # pattern is a sequence of steps, each binding one more vertex together
+    # with the edges between it and the vertices bound before it. Patterns
+    # starting with the same steps share a path in the trie, so the work of
+    # matching a common sub-pattern is done once for all of them.
+    class Node:
+        __slots__ = ('Children', 'Patterns')
+        def __init__(self):
+            self.Children = {}
+            self.Patterns = []
+
+    def __init__(self, patterns = []):
+        self.Root = PatternTrie.Node()
+        for key, pattern in patterns:
+            self.add(key, pattern)
+
+    def add(self, key, pattern):
+        node = self.Root
+        for step, v in self.__steps(pattern):
+            if step not in node.Children:
+                node.Children[step] = PatternTrie.Node()
+            node = node.Children[step]
+        node.Patterns.append((key, [v for _, v in self.__steps(pattern)]))
+
+    @staticmethod
+    def __step(pattern, v, index):
+        # The edges v closes once it is bound, with the vertices given by
+        # their binding position
+        d = len(index)
+        step = []
+        for e in pattern.EdgeMap[v]:
+            if all(u == v or u in index for u in e):
+                step.append((e.Label, tuple(index.get(u, d) for u in e)))
+        return tuple(sorted(step))
+
+    def __steps(self, pattern):
+        # The order does not depend on the graph matched against, so that
+        # equal sub-patterns of different patterns give the same steps.
+        # Vertices joined to bound ones come first, then the ones closing the
+        # most edges, then the smallest step.
+        index = {}
+        remaining = set(pattern.V)
+        steps = []
+        while remaining:
+            best = None
+            for v in remaining:
+                step = PatternTrie.__step(pattern, v, index)
+                joined = any(u in index for e in pattern.EdgeMap[v] for u in e)
+                key = (not joined, -len(step), step, v)
+                if best is None or key < best[0]:
+                    best = (key, step, v)
+            _, step, v = best
+            remaining.remove(v)
+            index[v] = len(index)
+            steps.append((step, v))
+        return steps
+
+    def match(self, g):
+        # (key, mapping) for every proper match of every pattern in g
+        keys = set()
+        unary = defaultdict(set)
+        for e in g.E:
+            keys.add((e.Label, e.Vertices))
+            if all(u == e.Vertices[0] for u in e.Vertices):
+                unary[(e.Label, len(e.Vertices))].add(e.Vertices[0])
+        yield from self.__match(self.Root, g, keys, unary, [], set())
+
+    def __match(self, node, g, keys, unary, hosts, used):
+        for key, order in node.Patterns:
+            if Instrumentation.Enabled:
+                Instrumentation.Counters['match.yielded'] += 1
+            yield key, VertexMapping(dict(zip(order, hosts)))
+        for step, child in node.Children.items():
+            for h in PatternTrie.__candidates(step, g, unary, hosts):
+                if h in used:
+                    continue
+                hosts.append(h)
+                if Instrumentation.Enabled:
+                    Instrumentation.Counters['match.tried'] += 1
+                if all(PatternTrie.__holds(label, indices, hosts, keys) for label, indices in step):
+                    used.add(h)
+                    yield from self.__match(child, g, keys, unary, hosts, used)
+                    used.remove(h)
+                hosts.pop()
+
+    @staticmethod
+    def __candidates(step, g, unary, hosts):
+        # Through a present edge to a bound vertex if there is one, else
+        # through a present edge on the new vertex alone
+        d = len(hosts)
+        for label, indices in step:
+            if label.startswith('~'):
+                continue
+            for j, k in enumerate(indices):
+                if k < d:
+                    i = indices.index(d)
+                    hu = hosts[k]
+                    return set(
+                        e.Vertices[i] for e in g.EdgeMap[hu]
+                        if e.Label == label and len(e.Vertices) == len(indices) and e.Vertices[j] == hu
+                    )
+        for label, indices in step:
+            if not label.startswith('~'):
+                return unary.get((label, len(indices)), ())
+        return g.V
+
+    @staticmethod
+    def __holds(label, indices, hosts, keys):
+        # As Graph.match with proper = True, a missing edge reads as negated
+        vertices = tuple(hosts[i] for i in indices)
+        if label.startswith('~'):
+            return (label[1:], vertices) not in keys
+        return (label, vertices) in keys and ('~' + label, vertices) not in keys
+
+
+class IncrementalMatcher:
+    # Proper matches of many patterns kept up to date along derived graphs.
+    # Patterns are split into the components their (non-negated) edges
+    # connect, isomorphic components are matched once through a PatternTrie,
+    # and the component matches of a graph are stored as a layer over those
+    # of the graph it was derived from. A derived graph only rematches
+    # around the vertices its changes touched; a pattern's matches are then
+    # the injective combinations of its components' matches that also
+    # respect the negated edges between components.
+    def __init__(self, patterns = []):
+        self.Components = []
+        self.Index = {}
+        self.Patterns = []
+        self.Trie = PatternTrie()
+        # How far from a touched vertex a component match can reach
+        self.Radius = 0
+        for key, pattern in patterns:
+            self.add(key, pattern)
+
+    def add(self, key, pattern, before = None):
+        # Only present edges keep the vertices of a match close together.
+        # before is as in Graph.match.
+        roots = {v: v for v in pattern.V}
+        def find(v):
+            while roots[v] != v:
+                v = roots[v]
+            return v
+        for e in pattern.E:
+            if not e.Neg:
+                for u in e:
+                    roots[find(u)] = find(e.Vertices[0])
+        components = defaultdict(set)
+        for v in pattern.V:
+            components[find(v)].add(v)
+
+        parts = []
+        free = []
+        cross = []
+        for component in components.values():
+            edges = set()
+            for v in component:
+                for e in pattern.EdgeMap[v]:
+                    if all(u in component for u in e):
+                        edges.add(e)
+                    else:
+                        cross.append(e)
+            if not edges:
+                # Matches any vertex not used by the rest of the pattern
+                free.extend(component)
+                continue
+            c = Graph(edges)
+            if c not in self.Index:
+                self.Index[c] = len(self.Components)
+                self.Components.append(c)
+                self.Trie.add(self.Index[c], c)
+                self.Radius = max(self.Radius, len(c.V) - 1)
+            # The i-th host of a match is the image of the i-th vertex of
+            # c in canonical order
+            parts.append((self.Index[c], c.canonical_order()))
+        self.Patterns.append((key, parts, free, set(cross), Graph.order_bounds(before)))
+
+    def matches(self, g):
+        # The component matches of g, from scratch
+        sets = {i: set() for i in range(len(self.Components))}
+        by_vertex = defaultdict(set)
+        for i, mapping in self.Trie.match(g):
+            self.__insert(sets, by_vertex, i, mapping)
+        return sets, by_vertex
+
+    def update(self, matches, g):
+        # The component matches of g, given those of the graph g was just
+        # derived from
+        touched = g.touched()
+        if touched is None:
+            return self.matches(g)
+        parent_sets, parent_by_vertex = matches
+        sets = {i: DeltaSet(s) for i, s in parent_sets.items()}
+        by_vertex = DeltaMap(parent_by_vertex)
+        for v in touched:
+            for item in list(by_vertex.lookup(v) or ()):
+                sets[item[0]].discard(item)
+                for u in item[1]:
+                    by_vertex.writable(u).discard(item)
+
+        region = set(v for v in touched if v in g.V)
+        boundary = set(region)
+        for i in range(self.Radius):
+            boundary = set(u for v in boundary for e in g.EdgeMap[v] for u in e) - region
+            region |= boundary
+        local = g[region]
+        for v in region:
+            local.add_vertex(v)
+        for i, mapping in self.Trie.match(local):
+            if any(v in touched for v in mapping.AtoB.values()):
+                self.__insert(sets, by_vertex, i, mapping)
+        return sets, by_vertex
+
+    def __insert(self, sets, by_vertex, i, mapping):
+        item = (i, tuple(mapping[v] for v in self.Components[i].canonical_order()))
+        sets[i].add(item)
+        for u in item[1]:
+            if isinstance(by_vertex, DeltaMap):
+                by_vertex.writable(u).add(item)
+            else:
+                by_vertex[u].add(item)
+
+    def applicable(self, g, matches):
+        # (key, mapping) for every proper match of every pattern in g
+        sets, _ = matches
+        for key, parts, free, cross, bounds in self.Patterns:
+            yield from self.__combine(g, sets, key, parts, free, cross, bounds, {}, set())
+
+    def __combine(self, g, sets, key, parts, free, cross, bounds, mapping, used, depth = 0):
+        if depth == len(parts) + len(free):
+            for e in cross:
+                if Edge(e.Label.lstrip('~'), [mapping[u] for u in e]) in g.E:
+                    return
+            yield key, VertexMapping(mapping)
+            return
+        if depth < len(parts):
+            i, order = parts[depth]
+            for _, hosts in sets[i]:
+                if used.isdisjoint(hosts):
+                    mapping.update(zip(order, hosts))
+                    used.update(hosts)
+                    if all(Graph.ordered(v, mapping, bounds) for v in order):
+                        yield from self.__combine(g, sets, key, parts, free, cross, bounds, mapping, used, depth + 1)
+                    used.difference_update(hosts)
+                    for v in order:
+                        del mapping[v]
+        else:
+            v = free[depth - len(parts)]
+            for h in g.V:
+                if h not in used:
+                    mapping[v] = h
+                    used.add(h)
+                    if Graph.ordered(v, mapping, bounds):
+                        yield from self.__combine(g, sets, key, parts, free, cross, bounds, mapping, used, depth + 1)
+                    used.remove(h)
+                    del mapping[v]
+
+
 if __name__ == '__main__':
     a = Vertex()
     b = Vertex()
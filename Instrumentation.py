@@ -0,0 +1,79 @@
+from collections import defaultdict
+import copy
+import json
+import sys
+
+# Opt-in counters, timers and series for the hot paths of matching and
+# compiling. Call sites check Enabled before recording anything, so with
+# it off the cost is one attribute lookup.
+#
+#   Instrumentation.enable()
+#   ase.compile(6)
+#   print(Instrumentation.snapshot())
+
+Enabled = False
+Counters = defaultdict(int)
+Timers = defaultdict(float)
+Series = defaultdict(list)
+
+def enable():
+    global Enabled
+    Enabled = True
+
+def disable():
+    global Enabled
+    Enabled = False
+
+def reset():
+    Counters.clear()
+    Timers.clear()
+    Series.clear()
+
+def record(name, **values):
+    Series[name].append(values)
+
+def snapshot():
+    # A plain copy of everything recorded so far
+    return {
+        'counters': dict(Counters),
+        'timers': dict(Timers),
+        'series': {name: [dict(r) for r in rows] for name, rows in Series.items()},
+    }
+
+def export(path):
+    with open(path, 'w') as f:
+        json.dump(snapshot(), f, indent = 2)
+
+def sizeof(x):
+    # Approximate size in bytes of x and everything it refers to
+    seen = set()
+    total = 0
+    stack = [x]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif isinstance(o, (str, bytes, int, float)):
+            continue
+        else:
+            if hasattr(o, '__dict__'):
+                stack.append(o.__dict__)
+            for slot in getattr(type(o), '__slots__', ()):
+                if hasattr(o, slot):
+                    stack.append(getattr(o, slot))
+    return total
+
+def deepcopy(x):
+    # copy.deepcopy, counting the copies and their size when enabled
+    y = copy.deepcopy(x)
+    if Enabled:
+        Counters['deepcopy.calls'] += 1
+        Counters['deepcopy.bytes'] += sizeof(y)
+    return y
@@ -0,0 +1,225 @@
+from Graph import Graph, Vertex, Edge
+from main import Action, AbstractGraph, AbstractStateExplorer, Constraint
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+# Scaling benchmarks for the ball sorting and ring moving domains.
+#
+#   python benchmarks.py --output bench_output.txt
+#   python benchmarks.py --baseline bench_output.txt
+#
+# Every case reports its wall time, peak traced memory and a count (states,
+# mappings, actions or search nodes expanded) that must not change between
+# runs of the same code.
+
+def dummy_actions(n):
+    # Actions over labels no other action or state uses, they only make
+    # the compile bigger
+    actions = []
+    for i in range(n):
+        a = Vertex()
+        actions.append(Action(f'dummy_{i}',
+            Graph([Edge(f'Dummy{i}', (a,))]),
+            Graph([Edge(f'Dummy{i}', (a,)), Edge(f'Done{i}', (a,))])))
+    return actions
+
+def ball_actions(dummies = 0):
+    a, b = Vertex(2)
+    return [
+        Action('sort_ball',
+            Graph([Edge('Ball', (a,)), Edge('Hand', (b,))]),
+            Graph([Edge('Ball', (a,)), Edge('Sorted', (a,)), Edge('Hand', (b,))])),
+        Action('buy_orange',
+            Graph([]),
+            Graph([Edge('Orange', (a,))])),
+    ] + dummy_actions(dummies)
+
+def ball_state(balls):
+    hand = Vertex()
+    return Graph([Edge('Hand', (hand,))] + [Edge('Ball', (Vertex(),)) for i in range(balls)])
+
+def ring_actions(dummies = 0):
+    a, b, c = Vertex(3)
+    return [
+        Action('Move Ring',
+            Graph([
+                Edge('Ring', (a,)),
+                Edge('Top', (a,)),
+                Edge('Top', (b,)),
+                ~Edge('Above', (a,b)),
+                ~Edge('Above', (b,a)),
+                Edge('Above', (a, c))
+            ]),
+            Graph([
+                Edge('Ring', (a,)),
+                Edge('Top', (a,)),
+                ~Edge('Top', (b,)),
+                Edge('Above', (a,b)),
+                ~Edge('Above', (b,a)),
+                ~Edge('Above', (a, c)),
+                Edge('Top', (c,))
+            ])),
+    ] + dummy_actions(dummies)
+
+def ring_state(rings, pegs = 3):
+    # All rings stacked on the first peg
+    bases = [Vertex() for i in range(pegs)]
+    edges = [Edge('Base', (b,)) for b in bases]
+    below = bases[0]
+    for i in range(rings):
+        r = Vertex()
+        edges += [Edge('Ring', (r,)), Edge('Above', (r, below))]
+        below = r
+    edges += [Edge('Top', (below,))] + [Edge('Top', (b,)) for b in bases[1:]]
+    return Graph(edges)
+
+def relabeled(g):
+    return g.clone()[0]
+
+def run(fn, repeat, memory):
+    # The best of repeat timed runs, then one more under tracemalloc for
+    # the peak memory since tracing slows everything down
+    seconds = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        count = fn()
+        t = time.perf_counter() - start
+        if seconds is None or t < seconds:
+            seconds = t
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'seconds': seconds, 'peak_bytes': peak, 'count': count}
+
+def compile_case(actions, depth):
+    def fn():
+        ase = AbstractStateExplorer(Constraint(), actions())
+        ase.compile(depth)
+        return len(ase.CompoundActionsList)
+    return fn
+
+def match_case(actions, state):
+    def fn():
+        g = state()
+        return sum(1 for a in actions() for _ in g.match(a.Input, proper = True))
+    return fn
+
+def eq_case(state):
+    def fn():
+        g = state()
+        h = relabeled(g)
+        return int(g == h and Graph(list(g.E)) == h)
+    return fn
+
+def abstract_match_case(actions):
+    def fn():
+        count = 0
+        for a in actions():
+            for b in actions():
+                count += sum(1 for _ in AbstractGraph(a.Input).match(b.Output))
+        return count
+    return fn
+
+def ball_goal(balls):
+    return Graph([Edge('Sorted', (Vertex(),)) for i in range(balls)])
+
+def ring_goal(rings):
+    # Two pegs with a ring straight on them, one move away from the start
+    edges = []
+    for i in range(min(rings, 2)):
+        r, b = Vertex(2)
+        edges += [Edge('Base', (b,)), Edge('Above', (r, b)), Edge('Ring', (r,))]
+    return Graph(edges)
+
+def find_solution_case(actions, state, goal, depth):
+    # Compiled once, only the search is timed
+    ase = AbstractStateExplorer(Constraint(goal()), actions())
+    ase.compile(depth)
+    def fn():
+        # Every run builds its own search matcher
+        ase.SearchMatcher = None
+        # The nodes the search expanded, whether or not it found a plan
+        ase.find_solution(state(), ase.Constraint.distance, max_nodes = 10000)
+        return ase.Expanded
+    return fn
+
+def cases(args):
+    for dummies in args.dummies:
+        for depth in args.ball_depths:
+            yield f'compile/ball/dummies={dummies}/depth={depth}', compile_case(lambda: ball_actions(dummies), depth)
+        for depth in args.ring_depths:
+            yield f'compile/ring/dummies={dummies}/depth={depth}', compile_case(lambda: ring_actions(dummies), depth)
+        yield f'abstract_match/ball/dummies={dummies}', abstract_match_case(lambda: ball_actions(dummies))
+        yield f'abstract_match/ring/dummies={dummies}', abstract_match_case(lambda: ring_actions(dummies))
+    for n in args.balls:
+        yield f'match/ball/balls={n}', match_case(ball_actions, lambda: ball_state(n))
+        yield f'eq/ball/balls={n}', eq_case(lambda: ball_state(n))
+        yield f'find_solution/ball/balls={n}', find_solution_case(ball_actions, lambda: ball_state(n), lambda: ball_goal(n), args.solve_depth)
+    for n in args.rings:
+        yield f'match/ring/rings={n}', match_case(ring_actions, lambda: ring_state(n))
+        yield f'eq/ring/rings={n}', eq_case(lambda: ring_state(n))
+        yield f'find_solution/ring/rings={n}', find_solution_case(ring_actions, lambda: ring_state(n), lambda: ring_goal(n), args.solve_depth)
+
+def compare(results, baseline, tolerance, noise):
+    # A case regresses if its count changed or it got slower than the
+    # baseline by more than the tolerance (and by more than the noise, so
+    # that the sub-millisecond cases do not flap)
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if b is None:
+            continue
+        if r['count'] != b['count']:
+            regressions.append(f'{name}: count {b["count"]} -> {r["count"]}')
+        elif r['seconds'] > b['seconds'] * (1 + tolerance) and r['seconds'] - b['seconds'] > noise:
+            regressions.append(f'{name}: {b["seconds"]:.4f}s -> {r["seconds"]:.4f}s')
+    return regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Scaling benchmarks for the ball and ring domains')
+    parser.add_argument('--balls', type = int, nargs = '*', default = [1, 2, 4, 8])
+    parser.add_argument('--rings', type = int, nargs = '*', default = [1, 2, 4, 8])
+    parser.add_argument('--dummies', type = int, nargs = '*', default = [0, 2])
+    parser.add_argument('--ball-depths', type = int, nargs = '*', default = [2, 4, 6, 8])
+    parser.add_argument('--ring-depths', type = int, nargs = '*', default = [2, 4])
+    parser.add_argument('--solve-depth', type = int, default = 3)
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--no-memory', action = 'store_true', help = 'skip the tracemalloc pass')
+    parser.add_argument('--output', help = 'write the results as JSON to this file')
+    parser.add_argument('--baseline', help = 'JSON results to compare against')
+    parser.add_argument('--tolerance', type = float, default = 0.25)
+    parser.add_argument('--noise', type = float, default = 0.005, help = 'seconds')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, fn in cases(args):
+        results[name] = r = run(fn, args.repeat, not args.no_memory)
+        peak = '' if r['peak_bytes'] is None else f'{r["peak_bytes"] / 1024:10.1f} KiB'
+        print(f'{name:45s} {r["seconds"]:9.4f}s {peak} {r["count"]:8d}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results,
+            }, f, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance, args.noise)
+        for r in regressions:
+            print('REGRESSION', r)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
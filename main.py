@@ -1,19 +1,99 @@
-from Graph import Graph, Vertex, Edge, VertexMapping
-from copy import deepcopy
-import itertools
-from queue import Queue
+from Graph import Graph, Vertex, Edge, VertexMapping, IncrementalMatcher
+from Instrumentation import deepcopy
+import Instrumentation
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from collections import defaultdict
+import hashlib
+import heapq
+import itertools
+import os
+import pickle
+import tempfile
+import tracemalloc
+
+# Bumped whenever the pickled layout of a compiled library changes
+LIBRARY_FORMAT = 4
+
+def memory_in_use():
+    # Bytes in use by this process right now: the traced memory while
+    # tracemalloc is tracing, the resident set size otherwise, or None
+    # where that cannot be read.
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
 
 class Constraint:
-    def __init__(self):
-        self.G = Graph([Edge('asdf', [Vertex()])])
+    def __init__(self, goal = None, forbidden = None):
+        # The patterns no state may contain, negated edges included
+        if forbidden is None:
+            forbidden = [Graph([Edge('asdf', [Vertex()])])]
+        self.Forbidden = list(forbidden)
+        # The pattern a solved state has to contain, any state not
+        # falsified is a solution without one
+        self.Goal = goal
 
     def falsified_by(self, g):
         # Returns True if there is no way to 
         # make the constraint True by adding more edges/nodes
-        # to the graph g.
-        #pass
-        return self.G in g
+        # to the graph g. That is the case when g has a forbidden
+        # pattern on distinct vertices with all of its edges, the
+        # negated ones included, explicitly there.
+        for f in self.Forbidden:
+            if not g.could_contain(f):
+                continue
+            for m in g.match(f):
+                if len(set(m.AtoB.values())) == len(m.AtoB):
+                    return True
+        return False
+
+    def violated_by(self, state):
+        # For a complete state, where a missing edge reads as negated
+        return any(state.could_match(f, proper = True) and any(state.match(f, proper = True)) for f in self.Forbidden)
+
+    def satisfied_by(self, g):
+        if self.violated_by(g):
+            return False
+        return self.Goal is None or any(g.match(self.Goal, proper = True))
+
+    def distance(self, g):
+        # How many goal edges of each label g is short of, a cheap
+        # heuristic for find_solution
+        if self.Goal is None:
+            return 0
+        counts = defaultdict(int)
+        for e in self.Goal.E:
+            if not e.Neg:
+                counts[e.Label] += 1
+        return sum(max(0, c - g.label_count(l)) for l, c in counts.items())
+
+class Trace:
+    # The last (label, mapping) step of a compound action's
+    # CompoundActionTracker, pointing at the trace of the compound action it
+    # was built from for the steps before it. Compound actions built from
+    # the same one share those steps instead of each copying them.
+    __slots__ = ('Label', 'Mapping', 'Parent', 'Length')
+
+    def __init__(self, label, mapping, parent = None):
+        self.Label = label
+        self.Mapping = mapping
+        self.Parent = parent
+        self.Length = 1 if parent is None else parent.Length + 1
+
+    def steps(self):
+        steps = []
+        trace = self
+        while trace is not None:
+            steps.append((trace.Label, trace.Mapping))
+            trace = trace.Parent
+        return steps[::-1]
+
+    def __len__(self):
+        return self.Length
 
 class Action:
     def __init__(self, label, input, output, mapping = None, compound = None):
@@ -33,27 +113,134 @@ class Action:
         self.ToRemove = set(v for v in self.Input.V if v not in self.InOutMapping)
 
         #this is used to track what actions/mappings are needed to complete a "compound action"
-        if compound is None:
-            compound = []
-        self.CompoundActionTracker = compound + [(self.Label, self.InOutMapping * ~out_mapping)]
+        #compound is the Trace of the compound action this one extends
+        self.Trace = Trace(self.Label, self.InOutMapping * ~out_mapping, compound)
+
+        self.build_action_graph()
+    
+    @property
+    def CompoundActionTracker(self):
+        # The (label, mapping) steps of Trace as a list, made on every call
+        return self.Trace.steps()
+
+    def __call__(self, g):
+        for mapping in g.match(self.Input, proper = True, before = self.symmetry()):
+            yield self.step(g, mapping)
+
+    def symmetry(self):
+        # Matches of Input that differ by an automorphism of the action
+        # lead to the same state. These ordering constraints on the input
+        # vertices keep one match of each, worked out on first use.
+        if self.Symmetry is None:
+            self.Symmetry = self.ActionGraph.symmetry_breaking(v for v in self.Input.V if v in self.ActionGraph.V)
+        return self.Symmetry
 
+    def step(self, g, mapping):
+        # The successor of g for a match of Input in it
+        _g = g.derive()
+        for v in self.ToRemove:
+            _g.remove_vertex(mapping[v])
+        m = (~self.InOutMapping) * mapping
+        _g.apply(self.Output, m)
+        return _g, m
+
+    def relabel(self):
+        # The same action over fresh vertices from this process' counter
+        a = Action.__new__(Action)
+        a.Label = self.Label
+        a.Input, in_mapping = self.Input.clone()
+        a.Output, out_mapping = self.Output.clone()
+        a.InOutMapping = ~(~self.InOutMapping * in_mapping) * out_mapping
+        a.ToRemove = set(v for v in a.Input.V if v not in a.InOutMapping)
+        a.Trace = self.Trace
+        a.build_action_graph()
+        return a
+
+    def build_action_graph(self):
         self.ActionGraph = Graph([*self.Input.E, *self.Output.E])
         for i,o in self.InOutMapping.AtoB.items():
             self.ActionGraph.add_edge(Edge('*', (i,o)))
-        self.ActionGraph.process()
-    
-    def __call__(self, g):
-        for mapping in g.match(self.Input, proper = True):
-            _g = deepcopy(g)
-            for v in self.ToRemove:
-                _g.remove_vertex(mapping[v])
-            m = (~self.InOutMapping) * mapping
-            _g.apply(self.Output, m)
-            yield _g, m
+
+        # Net effect of the action, used by is_solvedby and SubsumptionIndex
+        self.VertexDelta = len(self.Output.V) - len(self.Input.V)
+        self.EdgeDelta = len(self.Output.E) - len(self.Input.E)
+        counts = defaultdict(int)
+        for e in self.Input.E:
+            counts[e.Label] -= 1
+        for e in self.Output.E:
+            counts[e.Label] += 1
+        self.LabelDelta = {l: c for l, c in counts.items() if c != 0}
+        self.Symmetry = None
 
     def __invert__(self):
-        return Action(self.Output, self.Input, ~self.InOutMapping)
-    
+        return Action(self.Label, self.Output, self.Input, ~self.InOutMapping)
+
+    def regress(self, pattern):
+        # Patterns of the states this action takes to a state properly
+        # containing pattern, one for every way its effects can overlap the
+        # pattern. Read through the inverse action: its input is what this
+        # action leaves behind and its output what this action needs.
+        inverse = ~self
+        keys = set((e.Label, e.Vertices) for e in inverse.Input.E)
+        regressed = []
+        self.__overlaps(pattern, inverse, keys, sorted(pattern.V), {}, regressed)
+        for sigma in regressed:
+            # The edges of pattern this action does not add have to be
+            # there already, on top of what the action needs
+            mapping = {}
+            edges = [e.clone(mapping) for e in inverse.Output.E]
+            for e in pattern.E:
+                images = tuple(sigma.get(u) for u in e)
+                if None not in images and (e.Label, images) in keys:
+                    continue
+                vertices = [mapping[inverse.InOutMapping[sigma[u]]] if u in sigma else u for u in e]
+                edges.append(Edge(e.Label.lstrip('~'), vertices, e.Neg))
+            present = set((e.Label, e.Vertices) for e in edges)
+            if any((e.Label.lstrip('~'), e.Vertices) in present for e in edges if e.Neg):
+                continue
+            yield Graph(edges)
+
+    @staticmethod
+    def __negated(label):
+        return label[1:] if label.startswith('~') else '~' + label
+
+    def __overlaps(self, pattern, inverse, keys, order, sigma, regressed, depth = 0):
+        # Injective partial maps sigma from pattern onto the vertices the
+        # action leaves behind, under which every pattern edge is either
+        # added by the action or untouched by it, and at least one is added
+        if depth == len(order):
+            if any(
+                None not in images and (e.Label, images) in keys
+                for e in pattern.E
+                for images in [tuple(sigma.get(u) for u in e)]
+            ):
+                regressed.append(dict(sigma))
+            return
+        p = order[depth]
+        decided = set(order[:depth + 1])
+        used = set(sigma.values())
+        for o in itertools.chain([None], (o for o in inverse.Input.V if o not in used)):
+            if o is not None:
+                sigma[p] = o
+            consistent = True
+            for e in pattern.EdgeMap[p]:
+                if not all(u in decided for u in e):
+                    continue
+                images = tuple(sigma.get(u) for u in e)
+                if None not in images and (e.Label, images) in keys:
+                    continue
+                if None not in images and (Action.__negated(e.Label), images) in keys:
+                    consistent = False
+                # Edges that stay have to be on vertices the action keeps
+                elif any(v is not None and v not in inverse.InOutMapping for v in images):
+                    consistent = False
+                if not consistent:
+                    break
+            if consistent:
+                self.__overlaps(pattern, inverse, keys, order, sigma, regressed, depth + 1)
+            if o is not None:
+                del sigma[p]
+
     def __str__(self):
         return f'{self.Input}\n----\n{self.InOutMapping}\n----\n{self.Output}'
 
@@ -63,27 +250,31 @@ class Action:
     def __hash__(self):
         return hash(self.ActionGraph)
     def __eq__(self, other):
+        if not isinstance(other, Action):
+            return NotImplemented
         return self.ActionGraph == other.ActionGraph
 
+    def untraced_state(self):
+        # The attributes but Trace, for storing an action apart from the
+        # trace steps it shares with others
+        state = dict(self.__dict__)
+        del state['Trace']
+        return state
+
+    @staticmethod
+    def from_state(state, trace):
+        a = Action.__new__(Action)
+        a.__dict__.update(state)
+        a.Trace = trace
+        return a
+
     def is_solvedby(self, other):
-        if len(self.Input.V) - len(other.Input.V) != len(self.Output.V) - len(other.Output.V):
+        if self.VertexDelta != other.VertexDelta:
             return False
-        if len(self.Input.E) - len(other.Input.E) != len(self.Output.E) - len(other.Output.E):
+        if self.EdgeDelta != other.EdgeDelta:
             return False
-        self_counts = defaultdict(int)
-        other_counts = defaultdict(int)
-
-        for e in self.Input.E:
-            self_counts[e.Label] -= 1
-        for e in other.Input.E:
-            other_counts[e.Label] -= 1
-        for e in self.Output.E:
-            self_counts[e.Label] += 1
-        for e in other.Output.E:
-            other_counts[e.Label] += 1
-
-        for e, c in self_counts.items():
-            if c != 0 and other_counts[e] != c:
+        for e, c in self.LabelDelta.items():
+            if other.LabelDelta.get(e) != c:
                 return False
         # This is wrong for relationships
         return True
@@ -95,7 +286,6 @@ class Action:
             g = deepcopy(self.Input)
             m = ~other.InOutMapping * mapping
             g.apply(other.Output, m)
-            g.process()
             if g == self.Output:
                 return True
         return False
@@ -103,6 +293,65 @@ class Action:
     def __len__(self):
         return len(self.ActionGraph.V)
 
+class SpillStore:
+    # Actions pickled to an unnamed temporary file in a directory and read
+    # back by offset. The file goes away with the store.
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok = True)
+        self.File = tempfile.TemporaryFile(dir = directory)
+
+    def write(self, a):
+        self.File.seek(0, os.SEEK_END)
+        offset = self.File.tell()
+        pickle.dump(a.untraced_state(), self.File, pickle.HIGHEST_PROTOCOL)
+        return offset
+
+    def read(self, offset, trace):
+        self.File.seek(offset)
+        return Action.from_state(pickle.load(self.File), trace)
+
+class SpilledAction:
+    # What compile keeps in memory of a compound action that was spilled:
+    # the key it is told apart from other actions by, and the deltas the
+    # SubsumptionIndex needs. Equal to the action it stands for, load()
+    # reads that back. Pickled as that action.
+    __slots__ = ('Store', 'Offset', 'Trace', 'Canonical', 'Size', 'VertexDelta', 'EdgeDelta', 'LabelDelta')
+
+    def __init__(self, store, a):
+        self.Store = store
+        self.Offset = store.write(a)
+        self.Trace = a.Trace
+        self.Canonical = a.ActionGraph.canonical()
+        self.Size = len(a)
+        self.VertexDelta = a.VertexDelta
+        self.EdgeDelta = a.EdgeDelta
+        self.LabelDelta = a.LabelDelta
+
+    def load(self):
+        return self.Store.read(self.Offset, self.Trace)
+
+    @staticmethod
+    def key(a):
+        # The canonical ActionGraph of a, spilled or not
+        if isinstance(a, SpilledAction):
+            return a.Canonical
+        return a.ActionGraph.canonical()
+
+    def __reduce__(self):
+        return Action.from_state, (self.load().untraced_state(), self.Trace)
+
+    def __hash__(self):
+        return hash(self.Canonical)
+    def __eq__(self, other):
+        if isinstance(other, SpilledAction):
+            return self.Canonical == other.Canonical
+        if isinstance(other, Action):
+            return self.Canonical == other.ActionGraph.canonical()
+        return NotImplemented
+
+    def __len__(self):
+        return self.Size
+
 class AbstractGraph:
     def __init__(self, concrete_graph = None):
         if concrete_graph is None:
@@ -110,34 +359,24 @@ class AbstractGraph:
         self.ConcreteGraph = concrete_graph
     
     def match(self, g):
+        # Similar to Graph.match, except we are allowed to create new
+        # vertices and edges to satisfy the match. Each vertex of g is either
+        # anchored to a vertex of the concrete graph or created fresh; larger
+        # anchorings come first and each distinct result is yielded once.
         distinct_graphs = set()
-        # Similar to Graph.match, except we are allowed to create new 
-        # vertices and edges to satisfy the match
-        for r in range(len(g.V), -1, -1):
-            # Select which vertices of g to try to match against
-            # our sub graph. The remaining vertices will be created to 
-            # satisfy the rest of the match.
-            for combo in itertools.combinations(g.V, r):
-                _g = g[combo]
-                # for v in g.V - _g.V:
-                #     if g[combo + (v,)] in self.ConcreteGraph:
-                #         continue
-                #         break
-                # else:
-                for mapping in self.ConcreteGraph.match(_g):
-                    # Mapping starts as a partial mapping, but then
-                    # the full mapping is infered by making new vertices when
-                    # applying the graph to the current concrete one
-                    next_concrete_graph = deepcopy(self.ConcreteGraph)
-                    next_concrete_graph.apply(g, mapping)
-                    # for v in next_concrete_graph.V - set(mapping.values()):
-                    #     next_concrete_graph.remove_vertex(v)
-
-                    next_concrete_graph.prune()
-                    next_concrete_graph.process()
-                    if next_concrete_graph not in distinct_graphs:
-                        distinct_graphs.add(next_concrete_graph)
-                        yield next_concrete_graph, mapping
+        position = {v: i for i, v in enumerate(g.V)}
+        anchorings = list(self.ConcreteGraph.partial_match(g))
+        anchorings.sort(key = lambda m: (-len(m.AtoB), sorted(position[v] for v in m.AtoB)))
+        for mapping in anchorings:
+            # Mapping starts as a partial mapping, but then
+            # the full mapping is infered by making new vertices when
+            # applying the graph to the current concrete one
+            next_concrete_graph = self.ConcreteGraph.derive()
+            next_concrete_graph.apply(g, mapping)
+            next_concrete_graph.prune()
+            if next_concrete_graph not in distinct_graphs:
+                distinct_graphs.add(next_concrete_graph)
+                yield next_concrete_graph, mapping
 
     def __str__(self):
         return str(self.ConcreteGraph)
@@ -150,78 +389,666 @@ class AbstractGraph:
         return self.ConcreteGraph == other.ConcreteGraph
 
 
+def label_groups():
+    # A module level factory rather than a lambda, so that an index (and an
+    # explorer holding one) can be pickled
+    return defaultdict(set)
+
+class SubsumptionIndex:
+    # Actions grouped by vertex and edge delta, with an inverted index from
+    # each (label, net count) to the actions that have it. The actions that
+    # solve a given one are then those in its group that have all of its
+    # non-zero label counts.
+    def __init__(self, actions = []):
+        self.Groups = defaultdict(label_groups)
+        self.Actions = defaultdict(set)
+        for a in actions:
+            self.add(a)
+
+    def add(self, a):
+        key = (a.VertexDelta, a.EdgeDelta)
+        self.Actions[key].add(a)
+        for item in a.LabelDelta.items():
+            self.Groups[key][item].add(a)
+
+    def remove(self, a):
+        key = (a.VertexDelta, a.EdgeDelta)
+        self.Actions[key].discard(a)
+        for item in a.LabelDelta.items():
+            self.Groups[key][item].discard(a)
+
+    def solvers(self, a):
+        key = (a.VertexDelta, a.EdgeDelta)
+        if not a.LabelDelta:
+            solvers = set(self.Actions[key])
+        else:
+            group = self.Groups[key]
+            candidates = sorted((group[item] for item in a.LabelDelta.items()), key = len)
+            solvers = candidates[0].intersection(*candidates[1:])
+        if Instrumentation.Enabled:
+            Instrumentation.Counters['subsumption.lookups'] += 1
+            Instrumentation.Counters['subsumption.solvers'] += len(solvers)
+        return solvers
+
+    def is_solved(self, a):
+        # Whether some other action in the index solves a
+        return any(other is not a for other in self.solvers(a))
+
+
+# The explorer of a compile worker process, only its Actions are used
+WORKER_EXPLORER = None
+
+def init_worker(constraint, actions):
+    global WORKER_EXPLORER
+    WORKER_EXPLORER = AbstractStateExplorer(constraint, actions)
+
+def expand_in_worker(compound_action, first_id):
+    # New vertices are numbered from first_id, so the result only depends
+    # on the arguments and not on what the worker ran before.
+    Vertex.ID = first_id
+    return WORKER_EXPLORER.expand(compound_action)
+
+def init_planner(explorer):
+    # Every planning worker gets its copy of the explorer, compiled
+    # library included, once
+    global WORKER_EXPLORER
+    WORKER_EXPLORER = explorer
+
+def plan_in_worker(i, initial_state, first_id, heuristic, max_nodes, max_seconds, max_memory, bidirectional):
+    Vertex.ID = first_id
+    return i, WORKER_EXPLORER.find_solution(initial_state, heuristic, max_nodes, max_seconds, max_memory, bidirectional)
+
+
 class AbstractStateExplorer:
     def __init__(self, constraint, actions):
         self.Constraint = constraint
         self.Actions = actions
 
+        self.reset()
         self.CompoundActionsList = set()
+        # The actions and matcher of the last search, reused while the
+        # actions searched stay the same
+        self.SearchMatcher = None
+        # How many nodes the last search expanded
+        self.Expanded = 0
 
-    def compile(self, depth):
-        self.CompoundActionsList = set()
-        q = Queue()
-        for a in self.Actions:
-            q.put((1, a))
-            self.CompoundActionsList.add(a)
-
-        while not q.empty():
-            n, compound_action = q.get()
-            if n > depth:
-                break
-            found = False
+    def reset(self):
+        # Forget the compiled library. compile keeps these between calls:
+        # every compound action accepted so far with its subsumption index,
+        # the level being expanded with the position in it, the level it is
+        # producing, and how many levels are done. The library goes back to
+        # the base actions.
+        self.CompoundActionsList = list(self.Actions)
+        self.Compiled = set(self.Actions)
+        self.Index = SubsumptionIndex(self.Actions)
+        self.Frontier = list(self.Actions)
+        self.Position = 0
+        self.NextFrontier = []
+        self.Depth = 0
+
+    def compile(self, depth, workers = None, cache_dir = None, spill_dir = None, max_memory = None):
+        # Breadth first over compound actions, resuming from the previous
+        # call when depth is at least as deep. With workers > 1 every level
+        # is expanded on a process pool ahead of time, the results are then
+        # merged in the same order as the serial run so both produce the
+        # same library. With a cache_dir the library for these actions and
+        # depth is loaded from there if it was compiled before, and saved
+        # there otherwise. With a spill_dir expanded actions are spilled to a
+        # file there, see compile_stream.
+        path = None
+        if cache_dir is not None:
+            key = self.cache_key(depth)
+            path = os.path.join(cache_dir, key + '.lib')
+            if os.path.exists(path) and self.load(path, key):
+                return
+        for event in self.compile_stream(depth, workers, spill_dir = spill_dir, max_memory = max_memory):
+            pass
+
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok = True)
+            self.save(path, key)
+
+    def compile_stream(self, depth, workers = None, max_seconds = None, cancelled = None, spill_dir = None, max_memory = None):
+        # compile as a generator of (event, action, depth) as it goes: 'add'
+        # once a compound action is accepted into the level being built,
+        # 'remove' once one turns out to be solved by another. The library
+        # follows the events in CompoundActionsList, so it can be searched
+        # while it is built. Stops after max_seconds, or once cancelled()
+        # returns True, with the library pruned as compile leaves it, and a
+        # later call resumes from there. Closing the generator stops it at
+        # once, without the final pruning. A level stopped part way belongs
+        # to a deeper library, going back to its depth starts over, with
+        # 'remove' for every action of the library that goes and 'add' for
+        # the base actions that come back.
+        # With a spill_dir, compound actions that have been expanded are
+        # written to a temporary file there and stand in Compiled and Index
+        # as SpilledActions. That happens at the end of every level, or with
+        # max_memory whenever the memory in use has grown by that many bytes
+        # since the call started. The events stay the same, but the library
+        # is only followed by key and CompoundActionsList is set once the
+        # stream finishes.
+        if depth < self.Depth or (depth == self.Depth and (self.Position or self.NextFrontier)):
+            before = list(self.CompoundActionsList)
+            self.reset()
+            for a in before:
+                if a not in self.CompoundActionsList:
+                    yield 'remove', a, self.Depth
             for a in self.CompoundActionsList:
-                if not a is compound_action and compound_action.is_solvedby(a):
-                    found = True
-                    break
-            if found:
-                self.CompoundActionsList.remove(compound_action)
-                continue
-            intermediate = AbstractGraph(compound_action.Input)
-            for a in self.Actions:
-                for concrete_graph, out_to_graph in intermediate.match(a.Output):
-                    final_graph = deepcopy(concrete_graph)
-                    final_graph.apply(compound_action.Output, ~compound_action.InOutMapping.clone())
-                    in_to_graph = a.InOutMapping * out_to_graph
-                    concrete_graph.remove(a.Output, out_to_graph)
-                    concrete_graph.apply(a.Input, in_to_graph)
-
-                    concrete_graph.prune()
-                    concrete_graph.process()
-
-                    new_action = Action(a.Label,concrete_graph, final_graph, compound=deepcopy(compound_action.CompoundActionTracker))
-                    if new_action not in self.CompoundActionsList:
-                        self.CompoundActionsList.add(new_action)
-                        q.put((n+1,new_action))
-
-        cal = list(sorted(self.CompoundActionsList, key = len))
-        for i in reversed(range(len(cal))):
-            for j in range(i):
-                if cal[i].is_solvedby(cal[j]):
-                    del cal[i]
+                if a not in before:
+                    yield 'add', a, self.Depth
+        start = time.perf_counter()
+        store = library = baseline = None
+        if spill_dir is not None:
+            store = SpillStore(spill_dir)
+            streamed = set(map(SpilledAction.key, self.CompoundActionsList))
+            # The expanded actions not spilled yet, with their position in
+            # Frontier while it is the level being expanded
+            expanded = {id(a): i for i, a in enumerate(self.Frontier[:self.Position])}
+            waiting = set(map(id, self.Frontier[self.Position:] + self.NextFrontier))
+            resident = [(a, expanded.get(id(a))) for a in self.Compiled if isinstance(a, Action) and id(a) not in waiting]
+            if max_memory is not None:
+                baseline = memory_in_use()
+        else:
+            library = self.CompoundActionsList = list(self.CompoundActionsList)
+        stopped = False
+
+        pool = None
+        if workers is not None and workers > 1 and self.Frontier and self.Depth < depth:
+            pool = ProcessPoolExecutor(workers, initializer = init_worker, initargs = (self.Constraint, self.Actions))
+        try:
+            while self.Frontier and self.Depth < depth:
+                level_start = time.perf_counter()
+                frontier, new, pruned, forbidden = len(self.Frontier) - self.Position, 0, 0, 0
+                if pool is not None:
+                    # Every task starts numbering new vertices from the same id,
+                    # the merged actions are relabeled in this process.
+                    futures = {
+                        i: pool.submit(expand_in_worker, self.Frontier[i], Vertex.ID)
+                        for i in range(self.Position, len(self.Frontier))
+                    }
+                while self.Position < len(self.Frontier):
+                    if max_seconds is not None and time.perf_counter() - start >= max_seconds:
+                        stopped = True
+                    if cancelled is not None and cancelled():
+                        stopped = True
+                    if stopped:
+                        break
+                    compound_action = self.Frontier[self.Position]
+                    # Yielded once the action is done with, so that the
+                    # explorer is consistent whenever the caller has control
+                    events = []
+                    if self.Index.is_solved(compound_action):
+                        self.Compiled.remove(compound_action)
+                        self.Index.remove(compound_action)
+                        pruned += 1
+                        events.append(('remove', compound_action, self.Depth + 1))
+                    else:
+                        if pool is not None:
+                            new_actions = [a.relabel() for a in futures[self.Position].result()]
+                            # Share the earlier steps with compound_action
+                            # rather than with the worker's copy of it
+                            for a in new_actions:
+                                a.Trace = Trace(a.Trace.Label, a.Trace.Mapping, compound_action.Trace)
+                        else:
+                            new_actions = self.expand(compound_action)
+                        for new_action in new_actions:
+                            # Whatever state this leads to breaks the constraint
+                            if self.Constraint.falsified_by(new_action.Output):
+                                forbidden += 1
+                                continue
+                            if new_action not in self.Compiled:
+                                self.Compiled.add(new_action)
+                                self.Index.add(new_action)
+                                self.NextFrontier.append(new_action)
+                                new += 1
+                                events.append(('add', new_action, self.Depth + 1))
+                        if store is not None:
+                            resident.append((compound_action, self.Position))
+                    self.Position += 1
+                    if store is not None:
+                        if baseline is not None and memory_in_use() - baseline >= max_memory:
+                            self.__spill(store, resident)
+                    for event, a, level in events:
+                        if library is not None:
+                            if event == 'add':
+                                library.append(a)
+                            elif a in library:
+                                library.remove(a)
+                            else:
+                                continue
+                        elif event == 'add':
+                            streamed.add(SpilledAction.key(a))
+                        elif SpilledAction.key(a) in streamed:
+                            streamed.discard(SpilledAction.key(a))
+                        else:
+                            continue
+                        yield event, a, level
+                if stopped:
                     break
+                if store is not None:
+                    # Only the keys and deltas of an expanded level are
+                    # needed until the final pruning
+                    if baseline is None:
+                        self.__spill(store, resident)
+                    resident = [(a, None) for a, _ in resident]
+                self.Frontier, self.NextFrontier, self.Position = self.NextFrontier, [], 0
+                self.Depth += 1
+                if Instrumentation.Enabled:
+                    seconds = time.perf_counter() - level_start
+                    Instrumentation.Timers['compile'] += seconds
+                    Instrumentation.record('compile.depth', depth = self.Depth, frontier = frontier,
+                        new = new, pruned = pruned, forbidden = forbidden, seconds = seconds)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures = True)
+
+        # Keep the actions not solved by a smaller one, ties broken by the
+        # canonical form so that the library does not depend on set order
+        cal = []
+        index = SubsumptionIndex()
+        for a in sorted(self.Compiled, key = lambda a: (len(a), SpilledAction.key(a))):
+            if not index.is_solved(a):
+                cal.append(a)
+            index.add(a)
+        cal = [a.load() if isinstance(a, SpilledAction) else a for a in cal]
+        if library is not None:
+            kept = set(cal)
+            for a in [a for a in library if a not in kept]:
+                library.remove(a)
+                yield 'remove', a, self.Depth
+            streamed = set(library)
+            for a in cal:
+                if a not in streamed:
+                    library.append(a)
+                    yield 'add', a, self.Depth
+        else:
+            kept = set(map(SpilledAction.key, cal))
+            for a in list(self.Compiled):
+                key = SpilledAction.key(a)
+                if key in streamed and key not in kept:
+                    yield 'remove', a.load() if isinstance(a, SpilledAction) else a, self.Depth
+            for a in cal:
+                if SpilledAction.key(a) not in streamed:
+                    yield 'add', a, self.Depth
         self.CompoundActionsList = cal
         for a in cal:
             pass#print(a)
 
+    def __spill(self, store, resident):
+        # Write the actions of resident to store, leaving SpilledActions in
+        # their place in Compiled, Index and Frontier
+        for a, position in resident:
+            spilled = SpilledAction(store, a)
+            self.Compiled.remove(a)
+            self.Compiled.add(spilled)
+            self.Index.remove(a)
+            self.Index.add(spilled)
+            if position is not None:
+                self.Frontier[position] = spilled
+        resident.clear()
 
-    #tries the actions and compound actions 
-    #to see if one will work with the given input
-    #to satisfy the constraints
-    def find_solution(self, initial_state):
-        for a in self.CompoundActionsList:
-            #first apply the compound action
-            for curr_state, _ in a(initial_state):
-                print(curr_state)
+    def cache_key(self, depth):
+        # Compiling is deterministic in the base actions (in order), the
+        # forbidden patterns and the depth, the graphs are hashed through
+        # their canonical forms. ActionGraph does not tell input edges from
+        # output ones, so the key is taken over a copy with them tagged.
+        h = hashlib.sha256(f'{LIBRARY_FORMAT}:{depth}'.encode())
+        for a in self.Actions:
+            tagged = Graph([
+                *(Edge('in:' + e.Label.lstrip('~'), e.Vertices, e.Neg) for e in a.Input.E),
+                *(Edge('out:' + e.Label.lstrip('~'), e.Vertices, e.Neg) for e in a.Output.E),
+                *(Edge('*', (i, o)) for i, o in a.InOutMapping.AtoB.items()),
+            ])
+            h.update(f'|{a.Label}:{tagged.canonical()}'.encode())
+        for c in sorted(str(f.canonical()) for f in self.Constraint.Forbidden):
+            h.update(f'|forbidden:{c}'.encode())
+        return h.hexdigest()
+
+    def save(self, path, key = None):
+        # A header followed by one pickle per compiled action, so that load
+        # can stream the records back. The whole explorer state is kept, a
+        # loaded library can be compiled further. Trace steps are numbered
+        # and written once, with the first record that needs them, as
+        # (label, mapping, number of the parent step).
+        library = {a: i for i, a in enumerate(self.CompoundActionsList)}
+        frontier = {a: i for i, a in enumerate(self.Frontier[self.Position:])}
+        pending = {a: i for i, a in enumerate(self.NextFrontier)}
+        numbers = {}
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((LIBRARY_FORMAT, key, self.Depth, len(self.Compiled), Vertex.ID), f)
+            for a in self.Compiled:
+                if isinstance(a, SpilledAction):
+                    a = a.load()
+                steps = []
+                trace = a.Trace
+                while trace is not None and id(trace) not in numbers:
+                    steps.append(trace)
+                    trace = trace.Parent
+                written = []
+                for trace in reversed(steps):
+                    numbers[id(trace)] = len(numbers)
+                    parent = None if trace.Parent is None else numbers[id(trace.Parent)]
+                    written.append((trace.Label, trace.Mapping, parent))
+                record = (written, numbers[id(a.Trace)], a.untraced_state(), library.get(a), frontier.get(a), pending.get(a))
+                pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def load(self, path, key = None):
+        # Returns False, leaving the explorer as it was, if the file is from
+        # another format version or another key.
+        with open(path, 'rb') as f:
+            version, saved_key, depth, n, next_id = pickle.load(f)
+            if version != LIBRARY_FORMAT or (key is not None and saved_key != key):
+                return False
+            compiled = set()
+            index = SubsumptionIndex()
+            library, frontier, pending = [], [], []
+            traces = []
+            for i in range(n):
+                written, trace, state, l, fr, p = pickle.load(f)
+                for label, mapping, parent in written:
+                    traces.append(Trace(label, mapping, None if parent is None else traces[parent]))
+                a = Action.from_state(state, traces[trace])
+                compiled.add(a)
+                index.add(a)
+                for position, order in ((l, library), (fr, frontier), (p, pending)):
+                    if position is not None:
+                        order.append((position, a))
+
+        # The loaded vertices must not be handed out again
+        Vertex.ID = max(Vertex.ID, next_id)
+        self.Compiled = compiled
+        self.Index = index
+        self.Frontier = [a for _, a in sorted(frontier, key = lambda x: x[0])]
+        self.Position = 0
+        self.NextFrontier = [a for _, a in sorted(pending, key = lambda x: x[0])]
+        self.Depth = depth
+        self.CompoundActionsList = [a for _, a in sorted(library, key = lambda x: x[0])]
+        return True
+
+    def compile_more(self, levels = 1, workers = None):
+        # Deepen the current library in place
+        self.compile(self.Depth + levels, workers)
+
+    def expand(self, compound_action):
+        # Every compound action that is one base action followed by
+        # compound_action
+        new_actions = []
+        intermediate = AbstractGraph(compound_action.Input)
+        for a in self.Actions:
+            for concrete_graph, out_to_graph in intermediate.match(a.Output):
+                # The state between a and compound_action, no need to go
+                # on if it already breaks the constraint
+                if self.Constraint.falsified_by(concrete_graph):
+                    continue
+                final_graph = concrete_graph.derive()
+                final_graph.apply(compound_action.Output, ~compound_action.InOutMapping.clone())
+                in_to_graph = a.InOutMapping * out_to_graph
+                concrete_graph.remove(a.Output, out_to_graph)
+                concrete_graph.apply(a.Input, in_to_graph)
+
+                concrete_graph.prune()
+
+                new_actions.append(Action(a.Label,concrete_graph, final_graph, compound=compound_action.Trace))
+        return new_actions
+
+
+    def solutions(self, initial_state, heuristic = None, max_nodes = None, max_seconds = None, max_memory = None):
+        # Best-first search from initial_state over the base and compiled
+        # actions, yielding (plan, state) for every state that satisfies the
+        # constraint, cheapest first. A plan is the CompoundActionTracker of
+        # every action applied, in order, and the cost of a state is the
+        # number of base actions leading to it. heuristic(state) is added to
+        # the cost to order the frontier. The search stops once it has
+        # expanded max_nodes states, run for max_seconds or grown the memory
+        # in use by max_memory bytes.
+        self.Expanded = 0
+        if self.Constraint.violated_by(initial_state):
+            return
+        baseline = memory_in_use() if max_memory is not None else None
+        actions = self.search_actions()
+        matcher = self.matcher(actions)
+        if heuristic is None:
+            heuristic = lambda state: 0
+
+        start = time.perf_counter()
+        tie = itertools.count()
+        # (priority, estimate, tie, cost, state, action, parent, matches),
+        # equal priorities go to the state estimated closest to the goal
+        h = heuristic(initial_state)
+        root = (h, h, next(tie), 0, initial_state, None, None, matcher.matches(initial_state))
+        frontier = [root]
+        best = {initial_state: 0}
+        while frontier:
+            node = heapq.heappop(frontier)
+            _, _, _, cost, state, _, _, matches = node
+            if best.get(state, cost) < cost:
                 continue
-                #then check if it meets constraint
-                if self.Constraint.falsified_by(curr_state):
-                    print("this does not meet the constraint")
+            if self.Constraint.satisfied_by(state):
+                plan = []
+                while node[5] is not None:
+                    plan.append(node[5].CompoundActionTracker)
+                    node = node[6]
+                yield plan[::-1], state
+
+            if max_nodes is not None and self.Expanded >= max_nodes:
+                return
+            if max_seconds is not None and time.perf_counter() - start >= max_seconds:
+                return
+            if baseline is not None and memory_in_use() - baseline >= max_memory:
+                return
+            self.Expanded += 1
+            if Instrumentation.Enabled:
+                Instrumentation.Counters['search.expanded'] += 1
+
+            for a, next_state in self.successors(state, actions, matcher, matches):
+                next_cost = cost + len(a.Trace)
+                if best.get(next_state, next_cost + 1) <= next_cost:
                     continue
+                best[next_state] = next_cost
+                h = heuristic(next_state)
+                next_matches = matcher.update(matches, next_state)
+                heapq.heappush(frontier, (next_cost + h, h, next(tie), next_cost, next_state, a, node, next_matches))
+
+    def bidirectional_solutions(self, initial_state, max_nodes = None, max_seconds = None, max_memory = None):
+        # Breadth first from both ends: states forward from initial_state,
+        # and patterns backward from the goal by regressing it through the
+        # actions. A state containing a pattern is a candidate solution, the
+        # actions recorded from the pattern to the goal are then replayed
+        # on it to check it really gets there. Yields (plan, state) as
+        # solutions does.
+        if self.Constraint.Goal is None:
+            yield from self.solutions(initial_state, None, max_nodes, max_seconds, max_memory)
+            return
+        self.Expanded = 0
+        if self.Constraint.violated_by(initial_state):
+            return
+        actions = self.search_actions()
+        matcher = self.matcher(actions)
+        start = time.perf_counter()
+        baseline = memory_in_use() if max_memory is not None else None
+
+        # Nodes are (graph, action, parent). Forward the action led to the
+        # state from the parent, backward it leads from the pattern to the
+        # parent pattern. Forward nodes also keep the matches of the state.
+        forward = [(initial_state, None, None, matcher.matches(initial_state))]
+        backward = [(self.Constraint.Goal, None, None)]
+        states = {initial_state: forward[0]}
+        patterns = {self.Constraint.Goal: backward[0]}
+
+        def meet(state_node, pattern_node):
+            state = state_node[0]
+            if not any(state.match(pattern_node[0], proper = True)):
+                return None
+            chain = []
+            node = pattern_node
+            while node[1] is not None:
+                chain.append((node[1], node[2][0]))
+                node = node[2]
+            replayed = self.__replay(state, chain)
+            if replayed is None:
+                return None
+            plan = []
+            node = state_node
+            while node[1] is not None:
+                plan.append(node[1].CompoundActionTracker)
+                node = node[2]
+            return plan[::-1] + replayed[0], replayed[1]
+
+        for pattern_node in backward:
+            solution = meet(forward[0], pattern_node)
+            if solution is not None:
+                yield solution
+
+        while forward or backward:
+            # Grow the smaller frontier by a level
+            grow_forward = forward and (not backward or len(forward) <= len(backward))
+            level = []
+            for node in (forward if grow_forward else backward):
+                if max_nodes is not None and self.Expanded >= max_nodes:
+                    return
+                if max_seconds is not None and time.perf_counter() - start >= max_seconds:
+                    return
+                if baseline is not None and memory_in_use() - baseline >= max_memory:
+                    return
+                self.Expanded += 1
+                if Instrumentation.Enabled:
+                    Instrumentation.Counters['search.expanded'] += 1
+
+                if grow_forward:
+                    for a, state in self.successors(node[0], actions, matcher, node[3]):
+                        if state in states:
+                            continue
+                        states[state] = new = (state, a, node, matcher.update(node[3], state))
+                        level.append(new)
+                        for pattern_node in patterns.values():
+                            solution = meet(new, pattern_node)
+                            if solution is not None:
+                                yield solution
                 else:
-                    return a, curr_state
+                    for a in actions:
+                        for pattern in a.regress(node[0]):
+                            if pattern in patterns or self.Constraint.falsified_by(pattern):
+                                continue
+                            patterns[pattern] = new = (pattern, a, node)
+                            level.append(new)
+                            for state_node in states.values():
+                                solution = meet(state_node, new)
+                                if solution is not None:
+                                    yield solution
+            if grow_forward:
+                forward = level
+            else:
+                backward = level
 
+    def __replay(self, state, chain):
+        # Apply the actions of chain in turn, each has to reach a state
+        # containing the pattern paired with it. Returns the plan and final
+        # state, or None if there is no way through.
+        if not chain:
+            return [], state
+        a, pattern = chain[0]
+        for next_a, next_state in self.successors(state, [a]):
+            if not any(next_state.match(pattern, proper = True)):
+                continue
+            replayed = self.__replay(next_state, chain[1:])
+            if replayed is not None:
+                return [a.CompoundActionTracker] + replayed[0], replayed[1]
         return None
 
+    def matcher(self, actions, cache = True):
+        # An IncrementalMatcher over the inputs of actions, keyed by index,
+        # yielding one match per orbit of each action's automorphisms. Only
+        # a cached matcher replaces the one kept for the search actions.
+        if cache and self.SearchMatcher is not None:
+            cached, matcher = self.SearchMatcher
+            if len(cached) == len(actions) and all(a is b for a, b in zip(cached, actions)):
+                return matcher
+        matcher = IncrementalMatcher()
+        for i, a in enumerate(actions):
+            matcher.add(i, a.Input, a.symmetry())
+        if cache:
+            self.SearchMatcher = (list(actions), matcher)
+        return matcher
+
+    def search_actions(self):
+        # The base actions and the compiled ones that are not among them
+        actions = list(self.Actions)
+        actions += [a for a in self.CompoundActionsList if a not in actions]
+        return actions
+
+    def successors(self, state, actions, matcher = None, matches = None):
+        # (action, state) for every way of applying each action to state
+        # that does not falsify the constraint. The inputs of all actions
+        # are matched by matcher, built from actions if not given, with
+        # matches the ones it keeps for state. Callers keeping a successor
+        # get its matches from matcher.update before deriving from it.
+        if matcher is None:
+            matcher = self.matcher(actions, cache = False)
+        if matches is None:
+            matches = matcher.matches(state)
+        applicable = defaultdict(list)
+        for i, mapping in matcher.applicable(state, matches):
+            applicable[i].append(mapping)
+        for i, a in enumerate(actions):
+            for mapping in applicable[i]:
+                next_state, _ = a.step(state, mapping)
+                # Actions match states properly, where a missing edge
+                # already reads as negated. Dropping the negated edges
+                # the outputs add lets equal states be found as such.
+                # Only the changes are looked at, the state it was derived
+                # from has no negated edges and no vertices without edges.
+                touched = next_state.touched()
+                for e in [e for e in next_state.added() if e.Neg]:
+                    next_state.remove_edge(e)
+                next_state.prune(touched)
+                if self.Constraint.violated_by(next_state):
+                    continue
+                yield a, next_state
+
+    def find_solution(self, initial_state, heuristic = None, max_nodes = None, max_seconds = None, max_memory = None, bidirectional = False):
+        # The plan and final state of the cheapest solution found within the
+        # budgets, or None. The bidirectional search takes no heuristic and
+        # finds a short plan rather than the cheapest.
+        if bidirectional:
+            return next(self.bidirectional_solutions(initial_state, max_nodes, max_seconds, max_memory), None)
+        return next(self.solutions(initial_state, heuristic, max_nodes, max_seconds, max_memory), None)
+
+    def find_solutions(self, initial_states, heuristic = None, workers = None, max_nodes = None, max_seconds = None, max_memory = None, bidirectional = False, mp_context = None):
+        # find_solution for each of initial_states against the current
+        # library, yielding (i, plan, end_state) for the i-th state as soon as
+        # it is done, plan and end_state being None if it had no solution
+        # within the budgets. Every state gets the budgets to itself. With
+        # workers > 1 the states are spread over a process pool, each worker
+        # getting this explorer once when it starts: inherited under fork,
+        # pickled under spawn and forkserver (mp_context picks the start
+        # method). heuristic then has to pickle, as Constraint.distance does.
+        if workers is None or workers <= 1:
+            for i, initial_state in enumerate(initial_states):
+                solution = self.find_solution(initial_state, heuristic, max_nodes, max_seconds, max_memory, bidirectional)
+                yield (i,) + (solution or (None, None))
+            return
+
+        pool = ProcessPoolExecutor(workers, mp_context = mp_context, initializer = init_planner, initargs = (self,))
+        try:
+            futures = [
+                pool.submit(plan_in_worker, i, initial_state, Vertex.ID, heuristic, max_nodes, max_seconds, max_memory, bidirectional)
+                for i, initial_state in enumerate(initial_states)
+            ]
+            for future in as_completed(futures):
+                i, solution = future.result()
+                if solution is None:
+                    yield i, None, None
+                    continue
+                plan, end_state = solution
+                # The vertices a worker made must not be handed out again
+                if end_state.V:
+                    Vertex.ID = max(Vertex.ID, max(end_state.V) + 1)
+                yield i, plan, end_state
+        finally:
+            pool.shutdown(cancel_futures = True)
+
 if __name__ == '__main__':
     a, b, c, d = Vertex(4)
 
@@ -293,8 +1120,8 @@ if __name__ == '__main__':
         ase.compile(i)
         print(len(ase.CompoundActionsList))
     p.disable()
-    #sol, end_state = ase.find_solution(g) #right now it just returns the first action it applies just because anything meets the constraints
-    #print('solution', sol.CompoundActionTracker)
+    #plan, end_state = ase.find_solution(g, max_nodes = 1000)
+    #print('solution', plan)
     #print(end_state)
     #Stats(p).sort_stats('cumtime').print_stats()
 
@@ -0,0 +1,138 @@
+import itertools
+import random
+import unittest
+
+from Graph import Graph, Vertex, Edge, IncrementalMatcher, MatchCache
+
+# The matchers checked against brute force over every vertex mapping, on
+# small random graphs with negated edges and loops.
+
+def brute_force(host, pattern, proper, before = ()):
+    # Every mapping of pattern.V into host.V satisfying each edge of pattern
+    # as Graph.match does, injective if proper
+    keys = set((e.Label, tuple(e.Vertices)) for e in host.E)
+    vertices = sorted(pattern.V)
+    hosts = sorted(host.V)
+    found = set()
+    if len(vertices) > len(hosts):
+        return found
+    if proper:
+        images = itertools.permutations(hosts, len(vertices))
+    else:
+        images = itertools.product(hosts, repeat = len(vertices))
+    for image in images:
+        mapping = dict(zip(vertices, image))
+        if any(mapping[u] > mapping[v] for u, v in before):
+            continue
+        for e in pattern.E:
+            mapped = tuple(mapping[u] for u in e)
+            label = e.Label.lstrip('~')
+            if e.Neg:
+                holds = (label, mapped) not in keys and (proper or (e.Label, mapped) in keys)
+            else:
+                holds = (label, mapped) in keys and ('~' + label, mapped) not in keys
+            if not holds:
+                break
+        else:
+            found.add(frozenset(mapping.items()))
+    return found
+
+def random_graph(rnd, vertices, edges, negated, labels = 'ABC'):
+    vs = [Vertex() for i in range(vertices)]
+    return Graph([
+        Edge(rnd.choice(labels), [rnd.choice(vs) for i in range(rnd.choice([1, 1, 2, 2, 3]))], rnd.random() < negated)
+        for k in range(edges)
+    ])
+
+def mappings(matches):
+    return [frozenset(m.AtoB.items()) for m in matches]
+
+
+class MatchTest(unittest.TestCase):
+    def test_match(self):
+        rnd = random.Random(1)
+        for trial in range(1500):
+            # Few labels, so that non-injective matches often put several
+            # pattern edges on one host edge
+            host = random_graph(rnd, rnd.randint(1, 5), rnd.randint(1, 8), 0.15, 'AB')
+            pattern = random_graph(rnd, rnd.randint(1, 3), rnd.randint(1, 4), 0.3, 'AB')
+            for proper in (False, True):
+                found = mappings(host.match(pattern, proper))
+                self.assertEqual(len(found), len(set(found)))
+                self.assertEqual(set(found), brute_force(host, pattern, proper), (host, pattern, proper))
+
+    def test_match_before(self):
+        rnd = random.Random(2)
+        for trial in range(300):
+            host = random_graph(rnd, rnd.randint(2, 6), rnd.randint(1, 12), 0.15)
+            pattern = random_graph(rnd, rnd.randint(2, 3), rnd.randint(1, 4), 0.3)
+            if len(pattern.V) < 2:
+                continue
+            before = [tuple(rnd.sample(sorted(pattern.V), 2))]
+            found = mappings(host.match(pattern, proper = True, before = before))
+            self.assertEqual(set(found), brute_force(host, pattern, True, before), (host, pattern, before))
+
+
+class IncrementalMatcherTest(unittest.TestCase):
+    def check(self, matcher, patterns, g, matches):
+        found = {key: [] for key in range(len(patterns))}
+        for key, m in matcher.applicable(g, matches):
+            found[key].append(frozenset(m.AtoB.items()))
+        for key, pattern in enumerate(patterns):
+            self.assertEqual(len(found[key]), len(set(found[key])))
+            self.assertEqual(set(found[key]), brute_force(g, pattern, True), (g, pattern))
+
+    def test_update(self):
+        rnd = random.Random(3)
+        for trial in range(150):
+            host = random_graph(rnd, rnd.randint(1, 6), rnd.randint(1, 12), 0.15)
+            patterns = [random_graph(rnd, rnd.randint(1, 3), rnd.randint(0, 4), 0.3) for i in range(rnd.randint(1, 5))]
+            for pattern in patterns:
+                if rnd.random() < 0.3:
+                    pattern.add_vertex(Vertex())
+            matcher = IncrementalMatcher(enumerate(patterns))
+            matches = matcher.matches(host)
+            self.check(matcher, patterns, host, matches)
+            g = host
+            for step in range(rnd.randint(1, 8)):
+                g = g.derive()
+                for k in range(rnd.randint(1, 3)):
+                    r = rnd.random()
+                    if r < 0.4 and g.E:
+                        g.remove_edge(rnd.choice(sorted(g.E, key = str)))
+                    elif r < 0.55 and g.V:
+                        g.remove_vertex(rnd.choice(sorted(g.V)))
+                    else:
+                        vs = sorted(g.V) + [Vertex()]
+                        g.add_edge(Edge(rnd.choice('ABC'), [rnd.choice(vs) for i in range(rnd.choice([1, 2]))], rnd.random() < 0.15))
+                    if rnd.random() < 0.3:
+                        g.prune()
+                matches = matcher.update(matches, g)
+                self.check(matcher, patterns, g, matches)
+
+
+class MatchCacheTest(unittest.TestCase):
+    def tearDown(self):
+        Graph.Cache = None
+
+    def test_remapping(self):
+        # Isomorphic copies hit the same entries, their results have to be
+        # mapped onto the copy's own vertices
+        rnd = random.Random(4)
+        Graph.Cache = MatchCache(max_entries = 50)
+        for trial in range(200):
+            host = random_graph(rnd, rnd.randint(1, 6), rnd.randint(1, 12), 0.15)
+            pattern = random_graph(rnd, rnd.randint(1, 3), rnd.randint(0, 4), 0.3)
+            for copy in range(3):
+                h, _ = host.clone()
+                p, _ = pattern.clone()
+                for proper in (False, True):
+                    found = mappings(h.match(p, proper))
+                    self.assertEqual(len(found), len(set(found)))
+                    self.assertEqual(set(found), brute_force(h, p, proper), (h, p, proper))
+                    # Containment also needs every label at least as often
+                    self.assertEqual(p in h, h.could_contain(p) and bool(brute_force(h, p, False)))
+
+
+if __name__ == '__main__':
+    unittest.main()